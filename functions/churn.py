@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+
+def distinct_counts(groups, customers, group_count):
+    ## Distinct customers per group code: unique (group, customer) pairs counted with a bincount.
+    customer_count = customers.max() + 1 if len(customers) else 1
+    pairs = np.unique(groups.astype(np.int64) * customer_count + customers)
+    return np.bincount(pairs // customer_count, minlength=group_count)
+
+def churn_rates(data):
+    ## Share of distinct customers on a subscription line item with an inactive subscription, per created_month
+    ## overall and per (subscription_plan, created_month). Months, plans and customers are integer codes, so both
+    ## series come from deduplicated pair counts instead of a Python function per group.
+    subscribed = data[data['subscription_id'].notna() & data['created_month'].notna()]
+    month_codes, months = pd.factorize(subscribed['created_month'], sort=True)
+    customer_codes, _ = pd.factorize(subscribed['customer_key'])
+    inactive = (subscribed['subscription_status'] == 'inactive').to_numpy()
+
+    totals = distinct_counts(month_codes, customer_codes, len(months))
+    churned = distinct_counts(month_codes[inactive], customer_codes[inactive], len(months))
+    overall = pd.DataFrame({'Month': months, 'Overall Churn Rate': churned / totals})
+
+    ## Categorical columns keep their category order, like a groupby over them; rows without a value are left out.
+    values = subscribed['subscription_plan']
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        plan_codes, labels = values.cat.codes.to_numpy(), values.cat.categories
+    else:
+        plan_codes, labels = pd.factorize(values, sort=True)
+    present = plan_codes >= 0
+    groups = plan_codes.astype(np.int64) * len(months) + month_codes
+    group_count = len(labels) * len(months)
+
+    totals = distinct_counts(groups[present], customer_codes[present], group_count)
+    churned = distinct_counts(groups[present & inactive], customer_codes[present & inactive], group_count)
+    observed = np.flatnonzero(totals)
+    by_plan = pd.DataFrame({
+        'Subscription Plan': labels[observed // len(months)],
+        'Month': months[observed % len(months)],
+        'Churn Rate': churned[observed] / totals[observed],
+    })
+
+    return overall, by_plan
@@ -0,0 +1,103 @@
+import numpy as np
+import pandas as pd
+from functions.result_cache import cached_result
+
+## Cell colour of the cohort matrices, shaded by the rate shown in the cell.
+cohort_color = (0x30, 0x6B, 0xEA)
+
+def month_starts(dates):
+    return pd.Series(dates).to_numpy(dtype='datetime64[ns]').astype('datetime64[M]')
+
+def month_offsets(start, end):
+    ## Whole calendar months from start to end, from month numbers rather than Period objects; earlier ends are 0.
+    return np.maximum(0, (month_starts(end) - month_starts(start)).astype(np.int64))
+
+def cohort_counts(cohorts, offsets, flags=None):
+    ## Rows per (cohort month, month offset) and, with flags, flagged rows per cell, each with one 2-D bincount.
+    ## Rows with a missing cohort month are left out. Both matrices share the sorted cohorts and offsets present.
+    cohorts = month_starts(cohorts)
+    present = ~np.isnat(cohorts)
+    cohort_codes, cohort_months = pd.factorize(cohorts[present], sort=True)
+    offset_codes, offset_values = pd.factorize(np.asarray(offsets)[present], sort=True)
+    cells = cohort_codes * len(offset_values) + offset_codes
+    shape = (len(cohort_months), len(offset_values))
+
+    def matrix(weights=None):
+        counts = np.bincount(cells, weights=weights, minlength=shape[0] * shape[1]).astype(np.int64)
+        return pd.DataFrame(counts.reshape(shape), index=pd.DatetimeIndex(cohort_months), columns=offset_values)
+
+    if flags is None:
+        return matrix()
+    return matrix(), matrix(np.asarray(flags)[present])
+
+def subscription_cohorts(subscribed_data):
+    ## One row per subscription: the customer's creation time, subscription start and latest status.
+    return subscribed_data.groupby('subscription_key').agg({
+        'customer_created_at': 'first',
+        'subscription_period_started_at': 'first',
+        'subscription_status': 'last'
+    }).reset_index()
+
+def churn_matrix(cohort, cohort_column):
+    ## Subscriptions and churned subscriptions per cohort month of cohort_column and months since customer creation.
+    ## Only cohorts and offsets with any churn are kept; the rate is 0 where a cell has no subscriptions.
+    offsets = month_offsets(cohort['customer_created_at'], cohort['subscription_period_started_at'])
+    total, churned = cohort_counts(cohort[cohort_column], offsets, (cohort['subscription_status'] == 'inactive').to_numpy())
+    rows = churned.to_numpy().any(axis=1)
+    columns = churned.to_numpy().any(axis=0)
+    total, churned = total.loc[rows, columns], churned.loc[rows, columns]
+    return (churned / total).fillna(0), churned, total
+
+def retention_matrix(data):
+    ## Retention triangle by customer signup month: distinct customers with a line item in each month since signup,
+    ## over the number of customers who signed up in that month.
+    signups = data.groupby('customer_key')['customer_created_at'].min()
+    signup_months = pd.Series(month_starts(signups), index=signups.index)
+    row_signups = signup_months.reindex(data['customer_key']).to_numpy()
+    offsets = (month_starts(data['created_at']) - month_starts(row_signups)).astype(np.int64)
+
+    activity = pd.DataFrame({'customer_key': data['customer_key'].to_numpy(), 'signup': row_signups, 'offset': offsets})
+    activity = activity[(activity['offset'] >= 0) & activity['signup'].notna()].drop_duplicates(['customer_key', 'offset'])
+    retained = cohort_counts(activity['signup'], activity['offset'].to_numpy())
+
+    cohort_sizes = signup_months.value_counts().reindex(retained.index, fill_value=0).to_numpy()
+    totals = pd.DataFrame(np.repeat(cohort_sizes[:, None], retained.shape[1], axis=1), index=retained.index, columns=retained.columns)
+    return (retained / totals).fillna(0), retained, totals
+
+## Cohort views of the churn page and the name of their cohort month axis.
+cohort_views = {
+    'Subscription start churn': 'Subscription Start Month',
+    'Customer signup churn': 'Customer Signup Month',
+    'Customer signup retention': 'Customer Signup Month',
+}
+
+def cohort_matrix(data, subscribed_data, view):
+    ## Rate, count and total matrices of a cohort view, labelled for display by cohort month and month offset.
+    if view == 'Customer signup retention':
+        rate, counts, totals = retention_matrix(data)
+    else:
+        cohort_column = 'subscription_period_started_at' if view == 'Subscription start churn' else 'customer_created_at'
+        rate, counts, totals = churn_matrix(subscription_cohorts(subscribed_data), cohort_column)
+
+    for matrix in (rate, counts, totals):
+        matrix.index = matrix.index.strftime('%Y-%m').rename(cohort_views[view])
+        matrix.columns.name = 'Months Since Customer Creation'
+    return rate, counts, totals
+
+def get_cohort_matrix(data, subscribed_data, state_key, view):
+    ## state_key identifies the dataset, filter selections and subscription date range the inputs came from.
+    return cached_result(('cohort_matrix', view), state_key, lambda: cohort_matrix(data, subscribed_data, view))
+
+def cohort_labels(rate, counts, totals):
+    ## Cell text of a cohort matrix, "rate\n(count/total)", built over whole arrays.
+    percents = np.round(rate.to_numpy(dtype=float) * 100).astype(np.int64).astype(str)
+    text = np.char.add(np.char.add(percents, '%\n('), counts.to_numpy().astype(str))
+    text = np.char.add(np.char.add(np.char.add(text, '/'), totals.to_numpy().astype(str)), ')')
+    return pd.DataFrame(text.astype(object), index=rate.index, columns=rate.columns)
+
+def cohort_colors(rate):
+    ## Background colour of every cell, shaded by the rate rounded to whole percent as shown in the cell.
+    alphas = (np.round(rate.to_numpy(dtype=float) * 100) / 100).astype(str)
+    prefix = 'background-color: rgba(%d, %d, %d, ' % cohort_color
+    styles = np.char.add(np.char.add(prefix, alphas), ')')
+    return pd.DataFrame(styles.astype(object), index=rate.index, columns=rate.columns)
@@ -0,0 +1,121 @@
+import streamlit as st
+import numpy as np
+import pandas as pd
+from functions.query import date_range_bounds
+
+## Dimensions report aggregates can be rolled up by. Each query shape gets its own rollup over only the sidebar
+## filters, breakdowns and conditions it involves, so the cells stay few; anything else falls back to line items.
+cube_dimensions = ['created_month', 'payment_month', 'product_name', 'product_type', 'subscription_plan', 'subscription_status', 'billing_type', 'transaction_type', 'payment_method', 'customer_country', 'revenue_segment', 'customer_tenure_range']
+## Dimensions derived from a coarser rollup dimension rather than grouped on themselves.
+derived_dimensions = {'created_year': 'created_month'}
+## Enrichments computed over the selected date range; rollups involving them are built per range, and all others
+## once per dataset version over the full history.
+range_dimensions = ['revenue_segment', 'customer_tenure_range']
+
+def line_item_mrr(data):
+    ## Monthly recurring revenue of a line item, spreading its amount over the subscription period in 30 day months.
+    return data['total_amount'] / ((data['subscription_period_ended_at'] - data['subscription_period_started_at']).dt.days / 30)
+
+def build_cube(data, dimensions):
+    grouped_by = sorted({derived_dimensions.get(col, col) for col in dimensions})
+    measures = pd.DataFrame({'total_amount': data['total_amount'], 'line_items': 1}, index=data.index)
+    if 'subscription_period_started_at' in data.columns and 'subscription_period_ended_at' in data.columns:
+        measures['mrr'] = line_item_mrr(data)
+
+    if not grouped_by:
+        return measures.sum().to_frame().T
+
+    ## Rows with a missing dimension value are kept as their own cell so totals still match the line items.
+    grouped = pd.concat([data[grouped_by], measures], axis=1).groupby(grouped_by, observed=True, dropna=False, sort=False)
+    cube = grouped.sum().reset_index()
+    if 'created_year' in dimensions:
+        cube['created_year'] = cube['created_month'].dt.year
+    return cube
+
+@st.cache_resource(ttl=600, max_entries=64)
+
+def get_cube(_data, data_key, dimensions):
+    ## One rollup per dataset (and date range, where data_key has one) and set of dimensions, shared by every
+    ## session and selection.
+    return build_cube(_data, dimensions)
+
+def range_cube(history_cube, data, start_date, end_date, dimensions):
+    ## Cells of a full history rollup by created_month for the date range. Months wholly inside the range are
+    ## sliced from the rollup; the partial months at either edge are rolled up from their line items, which data
+    ## (the range's line items, sorted by created_at) holds as a leading and a trailing slice.
+    start, end = date_range_bounds(start_date, end_date)
+    first_full = start.to_period('M').to_timestamp()
+    if first_full < start:
+        first_full += pd.offsets.MonthBegin(1)
+    last_full = end.to_period('M').to_timestamp()
+    if first_full >= last_full:
+        return build_cube(data, dimensions)
+
+    months = history_cube['created_month']
+    parts = [history_cube[((months >= first_full) & (months < last_full)).to_numpy()]]
+    created_at = data['created_at']
+    for edge in (data.iloc[:created_at.searchsorted(first_full)], data.iloc[created_at.searchsorted(last_full):]):
+        if len(edge):
+            parts.append(build_cube(edge, dimensions))
+    return pd.concat(parts, ignore_index=True)
+
+class CubeView:
+    ## The date filtered line items (source) together with the page's active filter selections and the filtered
+    ## line items. Aggregations read a rollup when every filter, breakdown and condition is a cube dimension and
+    ## the measure is additive, and otherwise aggregate the filtered line items directly. With the full history
+    ## the range was sliced from, rollups are built over it once per dataset version and sliced to the range.
+    ## state_key identifies the dataset, date range and filter selections, for caching other summaries of the
+    ## filtered line items.
+    def __init__(self, source, selections, data, data_key=None, history=None):
+        self.source = source
+        self.history = history
+        self.data_key = data_key
+        self.selections = [(col, selected) for col, selected in selections if selected]
+        self.data = data
+        self.state_key = (data_key, tuple((col, tuple(sorted(map(str, selected)))) for col, selected in self.selections))
+
+    def dimensions(self, by, where):
+        return tuple(sorted(set([col for col, _ in self.selections] + list(by) + list(where))))
+
+    def answerable(self, dimensions, measure):
+        measures = ['total_amount', 'line_items']
+        if 'subscription_period_started_at' in self.source.columns and 'subscription_period_ended_at' in self.source.columns:
+            measures.append('mrr')
+        return measure in measures and all(derived_dimensions.get(col, col) in cube_dimensions and derived_dimensions.get(col, col) in self.source.columns for col in dimensions)
+
+    def rollup(self, dimensions):
+        if self.data_key is None:
+            return build_cube(self.source, dimensions)
+        if self.history is None or any(col in range_dimensions for col in dimensions):
+            return get_cube(self.source, self.data_key, dimensions)
+        version, start_date, end_date, columns = self.data_key
+        dimensions = tuple(sorted(set(dimensions) | {'created_month'}))
+        history_cube = get_cube(self.history, (version, columns), dimensions)
+        return range_cube(history_cube, self.source, start_date, end_date, dimensions)
+
+    def rows(self, frame, conditions):
+        mask = np.ones(len(frame), dtype=bool)
+        for col, values in conditions:
+            mask &= frame[col].isin(values).to_numpy()
+        return frame[mask]
+
+    def sum(self, by=None, measure='total_amount', where=None):
+        ## Sum of measure grouped by the columns in by (a scalar total when by is None), over rows matching where.
+        by_columns = [] if by is None else [by] if isinstance(by, str) else list(by)
+        where = where or {}
+
+        dimensions = self.dimensions(by_columns, where)
+        if self.answerable(dimensions, measure):
+            ## Rollups are unfiltered, so the sidebar selections are applied to them here as well.
+            rows = self.rows(self.rollup(dimensions), self.selections + list(where.items()))
+        else:
+            rows = self.rows(self.data, list(where.items()))
+
+        if measure not in rows.columns:
+            ## Line items have no line_items column; the count is the number of rows.
+            if by is None:
+                return len(rows)
+            return rows.groupby(by, observed=True).size()
+        if by is None:
+            return rows[measure].sum()
+        return rows.groupby(by, observed=True)[measure].sum()
@@ -0,0 +1,127 @@
+import threading
+import numpy as np
+import pandas as pd
+from functions.result_cache import cached_result
+
+## Display names for the customer table, in column order.
+customer_table_columns = {
+    'customer_id': 'ID',
+    'customer_name': 'Name',
+    'customer_email': 'Email',
+    'customer_city': 'City',
+    'customer_country': 'Country',
+    'total_amount': 'Total Spend',
+    'total_orders': 'total_orders',
+    'refund_amount': 'Total Refunds',
+    'discount_amount': 'Total Discounts',
+    'created_at': 'Last Order Date',
+    'customer_created_at': 'Created Date',
+}
+
+def customer_summary(data):
+    ## One row per customer in order of first appearance, computed in a single grouped pass over the integer
+    ## customer codes instead of one groupby per measure followed by a merge per measure.
+    codes, _ = pd.factorize(data['customer_key'])
+    first_rows = ~pd.Series(codes).duplicated().to_numpy()
+
+    summary = pd.DataFrame({
+        'code': codes,
+        'total_amount': data['total_amount'].to_numpy(),
+        'refund_amount': data['refund_amount'].to_numpy(),
+        'discount_amount': data['discount_amount'].to_numpy(),
+        'created_at': data['created_at'].to_numpy(),
+        'customer_created_at': data['customer_created_at'].to_numpy(),
+    }).groupby('code', sort=True).agg({
+        'total_amount': 'sum',
+        'refund_amount': 'sum',
+        'discount_amount': 'sum',
+        'created_at': 'max',
+        'customer_created_at': 'min',
+    })
+
+    ## Distinct orders per customer: count the unique (customer, order) pairs.
+    orders = pd.DataFrame({'code': codes, 'header_key': data['header_key'].to_numpy()}).drop_duplicates()
+    summary['total_orders'] = np.bincount(orders['code'].to_numpy(), minlength=len(summary))
+
+    ## The first row of every customer supplies the descriptive columns; codes follow first appearance.
+    details = data.loc[first_rows, ['customer_id', 'customer_name', 'customer_email', 'customer_city', 'customer_country']].reset_index(drop=True)
+    table = pd.concat([details, summary.reset_index(drop=True)], axis=1)
+
+    return table[list(customer_table_columns)].rename(columns=customer_table_columns)
+
+class CustomerTable:
+    ## The customer summary with a prefix search index over names and emails and cached sort orders, so a
+    ## search, sort or page change only selects row positions and the page shown is the only part serialized.
+    ## Each search column is kept as its lowercased values in sorted order together with their row positions;
+    ## the rows starting with a prefix are one contiguous run found with two binary searches.
+    def __init__(self, table, search_columns=('Name', 'Email')):
+        self.table = table
+        self.search_keys = {}
+        self.search_positions = {}
+        self.sort_ranks = {}
+        self.lock = threading.Lock()
+
+        for col in search_columns:
+            keys = table[col].fillna('').astype(str).str.lower().to_numpy(dtype=object)
+            order = np.argsort(keys, kind='stable')
+            self.search_keys[col] = keys[order]
+            self.search_positions[col] = order
+
+    def __getstate__(self):
+        ## The lock cannot be pickled into the shared cache; a fresh one is made on load.
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.table)
+
+    def matches(self, col, prefix):
+        ## Row positions, in table order, whose value in col starts with prefix (case insensitive).
+        keys = self.search_keys[col]
+        prefix = prefix.lower()
+        start = np.searchsorted(keys, prefix, side='left')
+        end = np.searchsorted(keys, prefix + '\U0010ffff', side='left')
+        return np.sort(self.search_positions[col][start:end])
+
+    def sort_rank(self, col, ascending=True):
+        ## Rank of every row in the order of col, with missing values last; built once per column and direction.
+        key = (col, ascending)
+        with self.lock:
+            rank = self.sort_ranks.get(key)
+        if rank is None:
+            rank = self.table[col].rank(method='first', ascending=ascending, na_option='bottom').to_numpy()
+            with self.lock:
+                self.sort_ranks[key] = rank
+        return rank
+
+    def select(self, searches=None, sort_by=None, ascending=True):
+        ## Row positions matching every (column, prefix) search, ordered by sort_by or else by table order.
+        positions = np.arange(len(self.table))
+        for col, prefix in (searches or {}).items():
+            if prefix:
+                positions = np.intersect1d(positions, self.matches(col, prefix), assume_unique=True)
+        if sort_by is not None:
+            positions = positions[np.argsort(self.sort_rank(sort_by, ascending)[positions], kind='stable')]
+        return positions
+
+    def page(self, positions, page, page_size):
+        ## The rows of one page (numbered from 1) of the selected positions.
+        start = (page - 1) * page_size
+        return self.table.iloc[positions[start:start + page_size]]
+
+def get_customer_table(data, state_key):
+    return cached_result('customer_table', state_key, lambda: CustomerTable(customer_summary(data)))
+
+def format_customer_rows(rows):
+    ## Format only the rows about to be displayed.
+    formatted = rows.copy()
+    for col in ['Total Spend', 'Total Refunds', 'Total Discounts']:
+        formatted[col] = formatted[col].map('${:,.2f}'.format)
+    for col in ['Last Order Date', 'Created Date']:
+        formatted[col] = formatted[col].dt.strftime('%Y-%m-%d')
+    return formatted
@@ -0,0 +1,86 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+## Seconds a loaded dataset is served before a background refresh checks the source for a newer version.
+refresh_seconds = int(os.environ.get('BILLING_REFRESH_SECONDS', '600'))
+
+class DatasetCache:
+    ## Loaded datasets per projection, served stale-while-revalidate. Only the first load of a projection runs on
+    ## the request path; once an entry is older than refresh_seconds the current frame is still returned and a
+    ## background thread loads the next one, which replaces the entry in a single assignment under the lock.
+    ## load(previous) gets the frame being served and may return it as is when the source has not changed.
+    def __init__(self, max_entries, refresh_seconds):
+        self.max_entries = max_entries
+        self.refresh_seconds = refresh_seconds
+        self.entries = OrderedDict()
+        self.refreshing = set()
+        self.key_locks = {}
+        self.refreshes = 0
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, load):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                key_lock = self.key_locks.setdefault(key, threading.Lock())
+
+        if entry is None:
+            ## Sessions asking for the same projection at once wait for one load instead of each running their own.
+            with key_lock:
+                with self.lock:
+                    entry = self.entries.get(key)
+                if entry is None:
+                    data = load(None)
+                    now = time.time()
+                    entry = {'data': data, 'loaded_at': now, 'checked_at': now}
+                    self.store(key, entry)
+                return entry['data']
+
+        with self.lock:
+            self.entries.move_to_end(key)
+            stale = time.time() - entry['checked_at'] >= self.refresh_seconds
+            if stale and key not in self.refreshing:
+                self.refreshing.add(key)
+                threading.Thread(target=self.refresh, args=(key, entry, load), daemon=True).start()
+        return entry['data']
+
+    def refresh(self, key, entry, load):
+        try:
+            data = load(entry['data'])
+        except Exception:
+            ## Keep serving the current frame and try again after another interval.
+            data = entry['data']
+            with self.lock:
+                self.failures += 1
+        now = time.time()
+        loaded_at = entry['loaded_at'] if data is entry['data'] else now
+        with self.lock:
+            self.refreshing.discard(key)
+            if data is not entry['data']:
+                self.refreshes += 1
+            if self.entries.get(key) is entry:
+                self.entries[key] = {'data': data, 'loaded_at': loaded_at, 'checked_at': now}
+
+    def store(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                evicted, _ = self.entries.popitem(last=False)
+                self.key_locks.pop(evicted, None)
+
+    def info(self, key):
+        ## Version and age of the frame served for key, for display and for keying downstream caches.
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            return {
+                'version': entry['data'].attrs.get('version'),
+                'age': time.time() - entry['loaded_at'],
+                'checked_age': time.time() - entry['checked_at'],
+                'refreshing': key in self.refreshing,
+            }
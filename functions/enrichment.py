@@ -0,0 +1,43 @@
+import streamlit as st
+import numpy as np
+import pandas as pd
+from datetime import datetime
+
+## Tenure bands by upper bound in months (inclusive); anything beyond the last bound is 5+ years.
+tenure_bounds = [6, 12, 24, 36, 48, 60]
+tenure_labels = ['0-6 months', '7-12 months', '1-2 years', '2-3 years', '3-4 years', '4-5 years', '5+ years']
+
+## Company revenue segments split at the 25th, 50th and 75th percentile of revenue in the selected range.
+revenue_quantiles = [0.25, 0.50, 0.75]
+revenue_labels = ['Low Revenue', 'Medium Revenue', 'High Revenue', 'Very High Revenue']
+
+def tenure_ranges(tenure_months):
+    positions = np.searchsorted(tenure_bounds, tenure_months, side='left')
+    ## Negative tenure (created in the future) falls through to the last band, as it always has.
+    positions = np.where(tenure_months < 0, len(tenure_labels) - 1, positions)
+    return pd.Categorical.from_codes(positions, categories=tenure_labels)
+
+def revenue_segments(company, amount):
+    ## Revenue is summed per company code with bincount and mapped back through the codes, instead of a
+    ## groupby plus merge that copies the whole frame. Rows without a company get no segment.
+    codes, companies = pd.factorize(company)
+    revenue_by_company = np.bincount(codes[codes >= 0], weights=np.nan_to_num(amount[codes >= 0]), minlength=len(companies))
+    thresholds = np.quantile(revenue_by_company, revenue_quantiles) if len(companies) else revenue_quantiles
+    segment_by_company = np.searchsorted(thresholds, revenue_by_company, side='right')
+    segment_codes = np.where(codes >= 0, segment_by_company[codes], -1)
+    return pd.Categorical.from_codes(segment_codes, categories=revenue_labels)
+
+@st.cache_resource(ttl=600, max_entries=16)
+
+def enrich_data(_data, data_key):
+    ## Customer tenure and revenue segment for the date filtered rows, computed once per dataset version and
+    ## date range (data_key) rather than on every filter click. The cached input frame is never modified.
+    current_date = pd.Timestamp(datetime.now())
+    tenure_months = ((current_date - _data['customer_created_at']) / pd.Timedelta(days=30)).astype(int).to_numpy()
+
+    enriched = _data.copy(deep=False)
+    enriched['customer_tenure_months'] = tenure_months
+    enriched['customer_tenure_range'] = tenure_ranges(tenure_months)
+    enriched['revenue_segment'] = revenue_segments(_data['customer_company'], _data['total_amount'].to_numpy())
+
+    return enriched
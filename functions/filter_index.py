@@ -0,0 +1,107 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+class FilterIndex:
+    ## Boolean mask index and facet catalog over the dimension filter columns of one dataset.
+    ## Each column is encoded once as integer codes ordered like its sorted string labels, with the row count
+    ## of every value. Per-value masks, per-column selection masks, the running AND across filters and the
+    ## facet counts under it are cached, so a filter change only recomputes what it touches.
+    def __init__(self, data, columns, max_cached_masks=128):
+        self.size = len(data)
+        self.codes = {}
+        self.labels = {}
+        self.positions = {}
+        self.counts = {}
+        self.masks = OrderedDict()
+        self.lock = threading.Lock()
+        self.max_cached_masks = max_cached_masks
+
+        for col in columns:
+            codes, uniques = pd.factorize(data[col])
+            labels = np.asarray(uniques.astype(str), dtype=object)
+            order = np.argsort(labels, kind='stable')
+            rank = np.empty(len(order), dtype=np.int32)
+            rank[order] = np.arange(len(order), dtype=np.int32)
+            self.codes[col] = np.where(codes >= 0, rank[codes], -1).astype(np.int32)
+            self.labels[col] = labels[order]
+            self.positions[col] = {label: i for i, label in enumerate(self.labels[col])}
+            self.counts[col] = self.bincount(col, self.codes[col])
+
+    def cached(self, key, build):
+        ## The index is shared between sessions, so the LRU bookkeeping is guarded; masks are built outside the lock.
+        with self.lock:
+            mask = self.masks.get(key)
+            if mask is not None:
+                self.masks.move_to_end(key)
+                return mask
+        mask = build()
+        with self.lock:
+            self.masks[key] = mask
+            if len(self.masks) > self.max_cached_masks:
+                self.masks.popitem(last=False)
+        return mask
+
+    def value_mask(self, col, position):
+        return self.cached(('value', col, position), lambda: self.codes[col] == position)
+
+    def column_mask(self, col, selected):
+        ## Rows whose value is in the selection. Selections one option larger than a cached one reuse it.
+        positions = frozenset(self.positions[col][label] for label in selected if label in self.positions[col])
+
+        def build():
+            for position in positions:
+                smaller = self.masks.get(('column', col, positions - {position}))
+                if smaller is not None:
+                    return smaller | self.value_mask(col, position)
+            mask = np.zeros(self.size, dtype=bool)
+            for position in positions:
+                mask |= self.value_mask(col, position)
+            return mask
+
+        return self.cached(('column', col, positions), build)
+
+    def bincount(self, col, codes):
+        return np.bincount(codes[codes >= 0], minlength=len(self.labels[col]))
+
+    def selection_key(self, selections):
+        return tuple((col, frozenset(selected)) for col, selected in selections if selected)
+
+    def combine(self, selections):
+        ## AND of the column masks for (column, selected options) pairs in order; None means no filter is set.
+        mask = None
+        prefix = ()
+        for col, selected in self.selection_key(selections):
+            prefix += ((col, selected),)
+            previous = mask
+            mask = self.cached(
+                ('combined', prefix),
+                lambda: self.column_mask(col, selected) if previous is None else previous & self.column_mask(col, selected)
+            )
+        return mask
+
+    def facet_counts(self, col, key):
+        ## Row counts per value of col under the filters in key. Counts are derived from the facet one filter
+        ## back by subtracting the rows the last filter removed, when that is the smaller side.
+        if not key:
+            return self.counts[col]
+
+        def build():
+            mask = self.combine(key)
+            parent = key[:-1]
+            parent_counts = self.facet_counts(col, parent)
+            parent_mask = self.combine(parent)
+            removed = ~mask if parent_mask is None else parent_mask & ~mask
+            removed_rows = np.count_nonzero(removed)
+            if removed_rows < self.size - removed_rows:
+                return parent_counts - self.bincount(col, self.codes[col][removed])
+            return self.bincount(col, self.codes[col][mask])
+
+        return self.cached(('facet', col, key), build)
+
+    def facet(self, col, selections=()):
+        ## Sorted labels present under the selections, with their row counts.
+        counts = self.facet_counts(col, self.selection_key(selections))
+        present = counts > 0
+        return list(self.labels[col][present]), [int(count) for count in counts[present]]
@@ -1,12 +1,17 @@
 import streamlit as st
-from datetime import datetime, timedelta
-from functions.query import query_results
-import pandas as pd
-
-def date_filter():
-    data = query_results()
-    min_created_at = data['created_at'].min()
-    max_created_at = data['created_at'].max()
+from datetime import timedelta
+from functions.query import query_bounds, date_range_bounds
+from functions.filter_index import FilterIndex
+
+## Columns the enrichment stage and setting_filters read, on top of whatever the page itself needs.
+filter_columns = ['created_at', 'customer_created_at', 'customer_company', 'total_amount', 'subscription_plan', 'customer_city', 'payment_method', 'billing_type', 'product_name', 'subscription_status']
+
+def date_filter(columns=None):
+    ## The created_at bounds come with the page's cached dataset, refreshed in the background along with it.
+    min_created_at, max_created_at = query_bounds(columns)
+    ## The date widget works with dates, so convert the datetime64 bounds at the edge.
+    min_created_at = min_created_at.date()
+    max_created_at = max_created_at.date()
     default_start_date = max_created_at - timedelta(days=365)
 
     if default_start_date < min_created_at:
@@ -19,7 +24,7 @@ def date_filter():
     if 'end_date' not in st.session_state:
         st.session_state.end_date = max_created_at
 
-    start_date, end_date = st.date_input(
+    selected_range = st.date_input(
         "(Required) Select your date range",
         value=(st.session_state.start_date, st.session_state.end_date),
         min_value=min_created_at,
@@ -27,7 +32,14 @@ def date_filter():
         format="MM/DD/YYYY"
     )
 
-    st.session_state.start_date, st.session_state.end_date = start_date, end_date
+    ## While only the start of a new range has been picked, keep using the last complete range, so the first
+    ## click of a range change does not reload and recompute the page.
+    if len(selected_range) == 2:
+        start_date, end_date = selected_range
+        st.session_state.start_date, st.session_state.end_date = start_date, end_date
+    else:
+        start_date, end_date = st.session_state.start_date, st.session_state.end_date
+        st.caption("Pick an end date to apply the new range.")
 
     if not start_date:
         st.warning("Please select a start date.")
@@ -36,57 +48,47 @@ def date_filter():
     elif start_date > end_date:
         st.warning("The start date cannot be after the end date. Please select a valid date range.")
 
-    return data, (start_date, end_date)
+    return start_date, end_date
 
 def filter_data(start, end, data_ref):
-    data_date_filtered = data_ref.query("`created_at` >= @start and `created_at` <= @end")
+    ## data_ref is sorted by created_at, so the range is one contiguous block located by binary search
+    ## and returned as a slice rather than a filtered copy.
+    start, end = date_range_bounds(start, end)
+    created_at = data_ref['created_at']
+    data_date_filtered = data_ref.iloc[created_at.searchsorted(start, side='left'):created_at.searchsorted(end, side='left')]
 
     return data_date_filtered
 
-def create_filter(column_name, filter_type='selectbox', options=None, selected_options=None, min_value=None, max_value=None):
+def create_filter(column_name, filter_type='selectbox', options=None, selected_options=None, min_value=None, max_value=None, option_counts=None, key=None):
     if filter_type == 'multiselect':
         valid_selected_options = [opt for opt in selected_options if opt in options] if selected_options else []
-        return st.multiselect(column_name, options, default=valid_selected_options)
+        if key is not None:
+            ## A widget inside a form only keeps its submitted value if it is recreated with the same options, labels
+            ## and default on the submit rerun, so the options stay fixed, counts stay out of the labels and the
+            ## value is seeded through session_state instead of default.
+            if key not in st.session_state:
+                st.session_state[key] = valid_selected_options
+            return st.multiselect(column_name, options, key=key)
+        ## Show how many line items each option matches under the filters set before this one.
+        format_func = (lambda opt: f"{opt} ({option_counts[opt]:,})") if option_counts else str
+        return st.multiselect(column_name, options, default=valid_selected_options, format_func=format_func)
     elif filter_type == 'date':
         return st.date_input(column_name, value=selected_options)
     return None
 
-def calculate_tenure_range(tenure_in_months):
-    ranges = [
-        (0, 6, '0-6 months'),
-        (7, 12, '7-12 months'),
-        (13, 24, '1-2 years'),
-        (25, 36, '2-3 years'),
-        (37, 48, '3-4 years'),
-        (49, 60, '4-5 years')
-    ]
-    
-    for start, end, label in ranges:
-        if start <= tenure_in_months <= end:
-            return label
-    
-    return '5+ years'
-
-def apply_filters(data, filter_values, columns):
-    for display_name, column_name, filter_type in columns:
-        if display_name in filter_values:
-            selected_options = filter_values[display_name]
-            if selected_options:
-                data = data[data[column_name].isin(selected_options)]
-
-    return data
-
-def categorize_revenue_dynamic(revenue, low_threshold, medium_threshold, high_threshold):
-    if revenue < low_threshold:
-        return 'Low Revenue'
-    elif revenue < medium_threshold:
-        return 'Medium Revenue'
-    elif revenue < high_threshold:
-        return 'High Revenue'
-    else:
-        return 'Very High Revenue'
+## The mask index is built once per dataset and date range and shared by every rerun and session that asks for it.
+@st.cache_resource(ttl=600, max_entries=16)
+
+def get_filter_index(_data, data_key, columns):
+    return FilterIndex(_data, columns)
 
-def setting_filters(data):
+def filter_options(data, col):
+    ## Every value of the column in the loaded dataset, whatever the date range and the other filters; the
+    ## categories of a sliced categorical are those of the whole dataset.
+    values = data[col].cat.categories if data[col].dtype == 'category' else data[col].dropna().unique()
+    return sorted(str(value) for value in values)
+
+def setting_filters(data, data_key=None, batch=False):
     with st.container():
         date_filtered_data = data
         col1, col2, col3, col4 = st.columns(4)
@@ -96,35 +98,13 @@ def setting_filters(data):
 
         filter_values = {}
 
-        current_date = pd.Timestamp(datetime.now())
-        date_filtered_data['customer_created_date'] = pd.to_datetime(date_filtered_data['customer_created_at'])
-        date_filtered_data['customer_tenure_months'] = ((current_date - date_filtered_data['customer_created_date']) / pd.Timedelta(days=30)).astype(int)
-        date_filtered_data['customer_tenure_range'] = date_filtered_data['customer_tenure_months'].apply(calculate_tenure_range)
-
-        # Calculate total lifetime revenue by company
-        revenue_by_company = date_filtered_data.groupby('customer_company')['total_amount'].sum().reset_index()
-
-        # Calculate dynamic thresholds based on percentiles
-        low_threshold = revenue_by_company['total_amount'].quantile(0.25)
-        medium_threshold = revenue_by_company['total_amount'].quantile(0.50)
-        high_threshold = revenue_by_company['total_amount'].quantile(0.75)
-
-        # Categorize revenue dynamically
-        revenue_by_company['revenue_segment'] = revenue_by_company['total_amount'].apply(categorize_revenue_dynamic, args=(low_threshold, medium_threshold, high_threshold))
-
-        # Merge the segment data back into the main dataset
-        date_filtered_data = pd.merge(date_filtered_data, revenue_by_company[['customer_company', 'revenue_segment']], on='customer_company', how='left')
-
-        def get_distinct_values(data, column_name):
-            return sorted(set(data[column_name].dropna().astype(str)))
-
         if 'filter_values' not in st.session_state:
             st.session_state.filter_values = {}
 
-        def update_filter(column_name, filter_type, options):
+        def update_filter(column_name, filter_type, options, option_counts=None, key=None):
             if column_name not in st.session_state.filter_values:
                 st.session_state.filter_values[column_name] = [] if filter_type == 'multiselect' else None
-            selected_options = create_filter(column_name, filter_type, options, selected_options=st.session_state.filter_values[column_name])
+            selected_options = create_filter(column_name, filter_type, options, selected_options=st.session_state.filter_values[column_name], option_counts=option_counts, key=key)
             st.session_state.filter_values[column_name] = selected_options
             return selected_options
 
@@ -139,17 +119,37 @@ def setting_filters(data):
             ("Subscription Status", 'subscription_status', 'multiselect')
         ]
 
+        ## Without a key identifying the dataset the index cannot be shared, so it is built for this rerun only.
+        filter_fields = [column_field for _, column_field, _ in columns]
+        if data_key is None:
+            index = FilterIndex(date_filtered_data, filter_fields)
+        else:
+            index = get_filter_index(date_filtered_data, data_key, filter_fields)
+
+        ## Each filter's options and counts come from the facet catalog under the filters before it. Selections
+        ## are resolved by AND-ing cached masks, and the frame is only subset once at the end.
+        ## When filters are applied together, the options are every value in the dataset and the line items the
+        ## selection matches are shown under the filter, so a submit that changes the counts keeps every pick.
+        selections = []
         for i, (column_name, column_field, filter_type) in enumerate(columns):
             if i < 4:
                 col = row1[i % 4]
             else:
                 col = row2[(i - 4) % 4]
             with col:
-                distinct_values = get_distinct_values(date_filtered_data, column_field)
-                selected_options = update_filter(column_name, filter_type, distinct_values)
+                distinct_values, value_counts = index.facet(column_field, selections)
+                option_counts = dict(zip(distinct_values, value_counts))
+                if batch:
+                    selected_options = update_filter(column_name, filter_type, filter_options(date_filtered_data, column_field), key=f"filter_{column_field}")
+                    matched = sum(option_counts.get(opt, 0) for opt in selected_options) if selected_options else sum(value_counts)
+                    st.caption(f"{matched:,} line items")
+                else:
+                    selected_options = update_filter(column_name, filter_type, distinct_values, option_counts)
                 filter_values[column_name] = selected_options
-                date_filtered_data = apply_filters(date_filtered_data, filter_values, columns)
+                selections.append((column_field, selected_options))
 
-        filtered_data = date_filtered_data
+        ## The input frame is cached and shared, so hand back a shallow copy the page can add columns to.
+        mask = index.combine(selections)
+        filtered_data = date_filtered_data.copy(deep=False) if mask is None else date_filtered_data[mask]
 
-    return filtered_data
\ No newline at end of file
+    return filtered_data, selections
\ No newline at end of file
@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+from functions.result_cache import cached_result
+
+class ActiveSubscriptionIndex:
+    ## Subscription periods as sorted start and end arrays. Overlapping or touching periods of the same
+    ## subscription are merged first, so a subscription is counted once at any time. The number of subscriptions
+    ## active at time T (start <= T < end) is then the starts at or before T less the ends at or before T,
+    ## two binary searches per time, vectorized over any array of times.
+    def __init__(self, keys, starts, ends):
+        keys = np.asarray(keys)
+        starts = pd.Series(starts).to_numpy(dtype='datetime64[ns]')
+        ends = pd.Series(ends).to_numpy(dtype='datetime64[ns]')
+        valid = (keys >= 0) & ~np.isnat(starts) & ~np.isnat(ends) & (ends > starts)
+        keys, starts, ends = keys[valid], starts[valid], ends[valid]
+
+        order = np.lexsort((starts, keys))
+        keys, starts, ends = keys[order], starts[order], ends[order]
+        covered = pd.Series(ends).groupby(keys, sort=False).cummax().to_numpy()
+
+        ## A period opens a new interval unless it starts before the subscription's earlier periods have ended.
+        opens = np.ones(len(keys), dtype=bool)
+        opens[1:] = (keys[1:] != keys[:-1]) | (starts[1:] > covered[:-1])
+        boundaries = np.flatnonzero(opens)
+        closes = np.append(boundaries[1:], len(keys)) - 1
+
+        self.starts = np.sort(starts[boundaries])
+        self.ends = np.sort(covered[closes])
+
+    def __len__(self):
+        return len(self.starts)
+
+    def active_at(self, times):
+        ## Number of subscriptions active at each of times.
+        times = pd.Series(times).to_numpy(dtype='datetime64[ns]')
+        return np.searchsorted(self.starts, times, side='right') - np.searchsorted(self.ends, times, side='right')
+
+    def active_by_month(self, months):
+        ## Number of subscriptions active at the end of each month, given the months' start dates.
+        month_ends = pd.DatetimeIndex(months) + pd.offsets.MonthBegin(1) - pd.Timedelta(1, 'ns')
+        return pd.Series(self.active_at(month_ends), index=pd.DatetimeIndex(months))
+
+def get_active_subscriptions(data, state_key):
+    return cached_result('active_subscriptions', state_key, lambda: ActiveSubscriptionIndex(
+        data['subscription_key'].to_numpy(),
+        data['subscription_period_started_at'],
+        data['subscription_period_ended_at']
+    ))
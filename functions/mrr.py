@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+from functions.cube import line_item_mrr
+from functions.result_cache import cached_result
+
+movement_types = ['new', 'expansion', 'contraction', 'churn']
+
+def month_numbers(dates):
+    return pd.Series(dates).to_numpy(dtype='datetime64[ns]').astype('datetime64[M]').astype(np.int64)
+
+def mrr_ledger(data):
+    ## MRR balance and movements from subscription periods. Every line item with a subscription adds its MRR to the
+    ## subscription from the month its period starts until the month it ends (at least one month). Period starts
+    ## and ends are sorted once per (subscription, month) and swept with a running sum per subscription; each
+    ## change in a subscription's MRR is a new, expansion, contraction or churn movement in that month.
+    ## Returns the movements per subscription and month, and per month the movements, net change and MRR balance.
+    ## The net change and balance include changes below zero, which no movement covers.
+    mrr = line_item_mrr(data).to_numpy(dtype=float)
+    keys = data['subscription_key'].to_numpy()
+    valid = (keys >= 0) & np.isfinite(mrr)
+    keys, mrr = keys[valid], mrr[valid]
+    starts = month_numbers(data['subscription_period_started_at'])[valid]
+    ends = np.maximum(month_numbers(data['subscription_period_ended_at'])[valid], starts + 1)
+
+    ## Endpoint events, summed per (subscription, month) in sorted order.
+    event_keys = np.concatenate([keys, keys])
+    event_months = np.concatenate([starts, ends])
+    event_deltas = np.concatenate([mrr, -mrr])
+    order = np.lexsort((event_months, event_keys))
+    event_keys, event_months, event_deltas = event_keys[order], event_months[order], event_deltas[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (event_keys[1:] != event_keys[:-1]) | (event_months[1:] != event_months[:-1])
+    boundaries = np.flatnonzero(first)
+    keys, months = event_keys[boundaries], event_months[boundaries]
+    deltas = np.add.reduceat(event_deltas, boundaries) if len(boundaries) else event_deltas
+
+    ## Running MRR per subscription after each of its months; sums that cancel out to rounding error are zero.
+    subscription_start = np.ones(len(keys), dtype=bool)
+    subscription_start[1:] = keys[1:] != keys[:-1]
+    after = pd.Series(deltas).groupby(keys, sort=False).cumsum().to_numpy()
+    after = np.where(np.abs(after) < 1e-6, 0, after)
+    before = np.where(subscription_start, 0, np.concatenate([[0], after[:-1]]))
+
+    ## Refunds can take a subscription below zero. Movements are classified on the MRR clipped at zero, so every
+    ## change of a subscription's positive MRR is booked; the balance sums every change, negative MRR included.
+    before_clipped = np.maximum(before, 0)
+    after_clipped = np.maximum(after, 0)
+    movement = np.select(
+        [
+            (before_clipped == 0) & (after_clipped > 0),
+            (before_clipped > 0) & (after_clipped > before_clipped),
+            (after_clipped > 0) & (after_clipped < before_clipped),
+            (before_clipped > 0) & (after_clipped == 0),
+        ],
+        movement_types,
+        default=''
+    )
+    changed = movement != ''
+    movements = pd.DataFrame({
+        'subscription_key': keys[changed],
+        'month': months[changed].astype('datetime64[M]').astype('datetime64[ns]'),
+        'movement': pd.Categorical(movement[changed], categories=movement_types),
+        'amount': (after_clipped - before_clipped)[changed],
+    })
+
+    ## Monthly totals over every month from the first to the last change.
+    month_index = months.astype('datetime64[M]').astype('datetime64[ns]')
+    if len(month_index):
+        month_range = pd.date_range(month_index.min(), month_index.max(), freq='MS')
+    else:
+        month_range = pd.DatetimeIndex([])
+    monthly = movements.pivot_table(index='month', columns='movement', values='amount', aggfunc='sum', observed=False, fill_value=0)
+    monthly = monthly.reindex(index=month_range, columns=movement_types, fill_value=0)
+    monthly.index.name = 'month'
+    monthly.columns.name = None
+    monthly['net'] = pd.Series(deltas).groupby(month_index).sum().reindex(month_range, fill_value=0).to_numpy()
+    monthly['mrr'] = monthly['net'].cumsum()
+    monthly['mrr'] = monthly['mrr'].where(monthly['mrr'].abs() >= 1e-6, 0)
+
+    return movements, monthly
+
+def get_mrr_ledger(data, state_key):
+    return cached_result('mrr_ledger', state_key, lambda: mrr_ledger(data))
+
+def mrr_at(monthly, month, column='mrr'):
+    ## Value of a monthly ledger column in month; the balance carries over past the last movement.
+    month = pd.Timestamp(month)
+    if column == 'mrr':
+        earlier = monthly.loc[monthly.index <= month, 'mrr']
+        return earlier.iloc[-1] if len(earlier) else 0
+    return monthly[column].get(month, 0)
@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+
+def period_key(dates, freq='year'):
+    ## Integer code of the year, quarter or month each date falls in: the year itself, or quarters/months
+    ## counted from year 0 (year * 4 + quarter - 1, year * 12 + month - 1). Missing dates get -1.
+    months = pd.Series(dates).to_numpy(dtype='datetime64[ns]').astype('datetime64[M]').astype(np.int64) + 1970 * 12
+    if freq == 'year':
+        codes = months // 12
+    elif freq == 'quarter':
+        codes = months // 3
+    else:
+        codes = months
+    return np.where(pd.isna(dates), -1, codes)
+
+def period_totals(data, key, periods, sums=(), distinct=(), counts=(), where=None):
+    ## Measures per period for the requested periods only, in one grouped pass: sums of the sums columns,
+    ## distinct values of the distinct columns and non-missing values of the counts columns, plus the row count
+    ## as 'rows'. key is a column of period codes (such as created_year) or an array of them (see period_key),
+    ## where an optional boolean row mask. The result is indexed by periods, with 0 for periods without rows.
+    keys = data[key].to_numpy() if isinstance(key, str) else np.asarray(key)
+    selected = np.isin(keys, periods)
+    if where is not None:
+        selected &= np.asarray(where)
+
+    rows = data.loc[selected, list(sums) + list(distinct) + list(counts)]
+    grouped = rows.groupby(keys[selected], sort=False)
+    totals = pd.concat([
+        grouped[list(sums)].sum() if sums else None,
+        grouped[list(distinct)].nunique() if distinct else None,
+        grouped[list(counts)].count() if counts else None,
+        grouped.size().rename('rows'),
+    ], axis=1)
+
+    return totals.reindex(list(periods)).fillna(0)
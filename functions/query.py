@@ -1,5 +1,30 @@
+import os
 import streamlit as st
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+from functions.sources import create_source
+from functions.shared_cache import get_shared_cache
+from functions.dataset_cache import DatasetCache, refresh_seconds
+
+## The loaded dataset is shared by every session, so pandas must never write through a view into it.
+## Copy-on-write makes slices and shallow copies zero-copy until something writes, and it is the default from pandas 3.
+if int(pd.__version__.split('.')[0]) < 3:
+    pd.set_option('mode.copy_on_write', True)
+
+## BILLING_SOURCE may point at a CSV or Parquet export, or at sqlite:///path.db / duckdb:///path.duckdb
+## holding BILLING_TABLE. The bundled sample export is used by default.
+source_url = os.environ.get('BILLING_SOURCE', 'data/example__line_item_enhanced.csv')
+source_table = os.environ.get('BILLING_TABLE', 'line_item_enhanced')
+## With BILLING_INCREMENTAL_DAYS set, a refresh after the source changed only pulls the rows created within that
+## many days of the loaded high-water mark on created_at and merges them into the frame being served.
+## The source still has to find those rows: Parquet files and SQL tables filter them on read, while a changed
+## CSV export is converted into a new snapshot in full first, so for CSV only the merge and encoding are saved.
+incremental_days = os.environ.get('BILLING_INCREMENTAL_DAYS')
+## Low cardinality dimensions are stored as categoricals and the UUID keys get int32 surrogate codes.
+category_columns = ['record_type', 'currency', 'header_status', 'product_name', 'transaction_type', 'billing_type', 'product_type', 'payment_method', 'subscription_plan', 'subscription_status', 'customer_level', 'customer_city', 'customer_country']
+id_columns = {'header_id': 'header_key', 'customer_id': 'customer_key', 'subscription_id': 'subscription_key'}
+date_columns = ['created_at', 'customer_created_at', 'payment_at', 'subscription_period_started_at', 'subscription_period_ended_at']
 
 data_columns = ['header_id',
                 'line_item_id',
@@ -39,18 +64,184 @@ data_columns = ['header_id',
                 'customer_country'
                 ]
 
-@st.cache_data(ttl=600)
+## Calendar keys used by the report pages, computed once per load instead of on every rerun.
+date_keys = {
+    'created_month': ('created_at', 'M'),
+    'created_quarter': ('created_at', 'Q'),
+    'payment_month': ('payment_at', 'M'),
+    'subscription_started_month': ('subscription_period_started_at', 'M'),
+}
+
+def add_date_keys(data):
+    for key_col, (date_col, freq) in date_keys.items():
+        if date_col in data.columns:
+            data[key_col] = data[date_col].dt.to_period(freq).dt.to_timestamp()
+    if 'created_at' in data.columns:
+        data['created_year'] = data['created_at'].dt.year
+
+    return data
+
+def encode_columns(data):
+    for col in category_columns:
+        if col in data.columns:
+            data[col] = data[col].astype('category')
+
+    ## The key column holds the int32 code used for nunique and groupby; the id column keeps the
+    ## original value as a categorical over the same codes, which doubles as the reverse lookup for display.
+    ## Missing ids are coded -1.
+    for id_col, key_col in id_columns.items():
+        if id_col not in data.columns:
+            continue
+        codes, uniques = pd.factorize(data[id_col])
+        data[key_col] = codes.astype('int32')
+        data[id_col] = pd.Categorical.from_codes(codes, categories=uniques)
+
+    return data
+
+def encode_increment(kept, delta):
+    ## Encodes delta rows against the frame they are merged into. Category columns get the sorted union of both
+    ## category sets, as a full load would; id columns keep their existing codes and append the new ids.
+    for col in category_columns:
+        if col in delta.columns:
+            categories = kept[col].cat.categories.union(pd.Index(delta[col].dropna().unique()))
+            kept[col] = kept[col].cat.set_categories(categories)
+            delta[col] = pd.Categorical(delta[col], categories=categories)
+
+    for id_col, key_col in id_columns.items():
+        if id_col not in delta.columns:
+            continue
+        categories = kept[id_col].cat.categories
+        values = delta[id_col]
+        new_ids = values[(categories.get_indexer(values) < 0) & values.notna()].unique()
+        categories = categories.append(pd.Index(new_ids))
+        codes = categories.get_indexer(values)
+        kept[id_col] = kept[id_col].cat.set_categories(categories)
+        delta[key_col] = codes.astype('int32')
+        delta[id_col] = pd.Categorical.from_codes(codes, categories=categories)
+
+    return kept, delta
+
+def merge_increment(previous, delta, window_start):
+    ## previous holds every row created before window_start; delta replaces the rest. A row that moved into the
+    ## window is found by its header_id and line_item_id and dropped from the kept rows, so it is not counted twice.
+    created_at = previous['created_at']
+    keep = ((created_at < window_start) | created_at.isna()).to_numpy(copy=True)
+    if 'header_id' in delta.columns and 'line_item_id' in delta.columns and len(delta):
+        header_codes = previous['header_id'].cat.categories.get_indexer(delta['header_id'])
+        candidates = keep & np.isin(previous['header_key'].to_numpy(), header_codes[header_codes >= 0])
+        if candidates.any():
+            updated = pd.MultiIndex.from_arrays([delta['header_id'], delta['line_item_id']])
+            pairs = pd.MultiIndex.from_arrays([previous['header_id'][candidates].astype(object), previous['line_item_id'][candidates]])
+            keep[np.flatnonzero(candidates)[pairs.isin(updated)]] = False
+
+    kept, delta = encode_increment(previous[keep], delta)
+    ## Kept rows before the window, the sorted delta, then the rows without a created_at, which sort last.
+    missing = kept['created_at'].isna().to_numpy()
+    data = pd.concat([kept[~missing], delta[kept.columns], kept[missing]], ignore_index=True)
+    return data
+
+@st.cache_resource
+
+def get_source():
+    return create_source(source_url, source_table, date_columns)
+
+def date_range_bounds(start, end):
+    ## Date widget values are inclusive days; sources take created_at >= start and < end.
+    start = pd.Timestamp(start) if start is not None else None
+    end = pd.Timestamp(end) + pd.Timedelta(days=1) if end is not None else None
+    return start, end
+
+def prepare_rows(query, columns):
+    data = pd.DataFrame(query, columns=columns)
+
+    ## Every timestamp stays datetime64 so filters and pages can compare and group without converting again.
+    for col in date_columns:
+        if col in data.columns and not pd.api.types.is_datetime64_any_dtype(data[col]):
+            data[col] = pd.to_datetime(data[col], errors='coerce')
+
+    ## Keep the frame ordered by created_at so date ranges can be sliced with searchsorted in filter_data.
+    if 'created_at' in data.columns:
+        data = data.sort_values('created_at', kind='stable', ignore_index=True)
+
+    return data
+
+def finish_dataset(data, version):
+    ## Downstream caches key on the version the frame was loaded from. The created_at bounds for the date widget
+    ## are kept with the frame, so they are served and refreshed together with it.
+    data.attrs['version'] = version
+    created_at = data['created_at'] if 'created_at' in data.columns else pd.Series(dtype='datetime64[ns]')
+    data.attrs['created_at_bounds'] = (created_at.min(), created_at.max())
+    return data
+
+def load_dataset(source, shared, columns, start, end, previous=None):
+    ## Read the version before the rows so a change made during the load shows up as a newer version later.
+    version = source.version()
+    if previous is not None and previous.attrs.get('version') == version:
+        return previous
+
+    ## With a shared cache tier, another server process may already have loaded and encoded this projection.
+    shared_path = None
+    if shared is not None:
+        shared.invalidate(version)
+        shared_path = shared.dataset_path(version, columns, start, end)
+        if os.path.exists(shared_path):
+            return finish_dataset(shared.read_dataset(shared_path), version)
+
+    start_bound, end_bound = date_range_bounds(start, end)
+    window_start = None
+    if incremental_days and previous is not None and 'created_at' in columns:
+        watermark = previous['created_at'].max()
+        if not pd.isna(watermark):
+            window_start = watermark - pd.Timedelta(days=float(incremental_days))
+            if start_bound is not None:
+                window_start = max(window_start, start_bound)
+
+    if window_start is not None:
+        ## Only the rows at or after the window start are read, parsed and encoded; the older ones are reused.
+        delta = add_date_keys(prepare_rows(source.load(columns, window_start, end_bound), columns))
+        data = merge_increment(previous, delta, window_start)
+    else:
+        data = add_date_keys(prepare_rows(source.load(columns, start_bound, end_bound), columns))
+        data = encode_columns(data)
+
+    ## The process that built the frame switches to the mapped file as well, dropping its private copy.
+    if shared_path is not None:
+        try:
+            shared.write_dataset(data, shared_path)
+            data = shared.read_dataset(shared_path)
+        except (OSError, pa.ArrowException):
+            pass
+
+    return finish_dataset(data, version)
+
+@st.cache_resource
+
+def get_dataset_cache():
+    return DatasetCache(8, refresh_seconds)
+
+def dataset_key(columns=None, start=None, end=None):
+    return (tuple(col for col in data_columns if columns is None or col in columns), start, end)
 
-def query_results():
-    ## Currently we are only pulling from the dummy sample data. However, this could be expanded for direct table in warehouse connection.
-    query = pd.read_csv('data/example__line_item_enhanced.csv', parse_dates=['created_at', 'customer_created_at', 'payment_at', 'subscription_period_started_at', 'subscription_period_ended_at'])
-    data = pd.DataFrame(query, columns=data_columns)
+## One frame per projection is held for the whole process and handed to every session as is, instead of
+## st.cache_data giving each caller its own deserialized copy. Callers treat it as read-only and add their
+## own columns to shallow copies, which copy-on-write keeps from touching the shared columns.
+## Past the refresh interval the current frame keeps being served while the next one loads in the background,
+## so only the very first load of a projection is waited on. The background load gets the source and shared
+## cache handed over, as it runs outside any session.
+def query_results(columns=None, start=None, end=None):
+    ## Only the requested columns are pulled from the source; the projection is pushed into the Parquet reader or
+    ## the SQL SELECT. Callers passing an explicit start or end also get that range pushed into the WHERE clause or
+    ## row group filter; the pages load the full history and slice date ranges from it in filter_data.
+    key = dataset_key(columns, start, end)
+    source = get_source()
+    shared = get_shared_cache()
+    with st.spinner('Loading data...'):
+        return get_dataset_cache().get(key, lambda previous: load_dataset(source, shared, list(key[0]), start, end, previous))
 
-    if 'created_at' in data.columns and not pd.api.types.is_datetime64_any_dtype(data['created_at']):
-        data['created_at'] = pd.to_datetime(data['created_at'])
-        
-    data_load_state = st.text('Loading data...')
-    data['created_at'] = data['created_at'].dt.date
-    data_load_state.text("Done! (using st.cache_data)")
+def query_bounds(columns=None):
+    ## Bounds of created_at in the dataset served for columns; nothing is read from the source on the request path.
+    return query_results(columns=columns).attrs['created_at_bounds']
 
-    return data
\ No newline at end of file
+def dataset_info(columns=None, start=None, end=None):
+    ## Version and age of the dataset currently served for a projection, or None before its first load.
+    return get_dataset_cache().info(dataset_key(columns, start, end))
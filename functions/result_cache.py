@@ -0,0 +1,114 @@
+import os
+import sys
+import hashlib
+import threading
+from collections import OrderedDict
+import streamlit as st
+import numpy as np
+import pandas as pd
+from functions.shared_cache import get_shared_cache
+
+## Memory budget of the section result cache, shared by every session of this server process.
+result_cache_mb = int(os.environ.get('BILLING_RESULT_CACHE_MB', '512'))
+
+def result_size(value, seen=None):
+    ## Approximate bytes held by a cached result: frames, arrays and the attributes of index objects.
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        usage = value.memory_usage(deep=True, index=True)
+        return int(usage.sum() if isinstance(value, pd.DataFrame) else usage)
+    if isinstance(value, pd.Index):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sys.getsizeof(value) + sum(result_size(item, seen) for item in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(result_size(item, seen) for item in value.values())
+    if hasattr(value, '__dict__'):
+        return sys.getsizeof(value) + result_size(vars(value), seen)
+    return sys.getsizeof(value)
+
+class ResultCache:
+    ## Process-wide LRU of computed section results within a memory budget. Entries are keyed on a hash of the
+    ## section name and the filter state (dataset version, date range, columns and sorted filter selections), so
+    ## every session looking at the same view gets the same result. Hits, misses and evictions are counted.
+    ## With a shared disk tier, a miss here is looked up there before computing, and new results are written to it.
+    def __init__(self, max_bytes, shared=None):
+        self.max_bytes = max_bytes
+        self.shared = shared
+        self.shared_hits = 0
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def key(self, section, state_key):
+        return hashlib.sha256(repr((section, state_key)).encode()).hexdigest()
+
+    def get(self, section, state_key, compute, version=None):
+        key = self.key(section, state_key)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        ## Computed outside the lock; two sessions missing at once both compute and the later one is kept.
+        value = self.shared.get(key) if self.shared is not None else None
+        if value is not None:
+            with self.lock:
+                self.shared_hits += 1
+        else:
+            value = compute()
+            if self.shared is not None:
+                self.shared.put(key, value, version)
+        size = result_size(value)
+        with self.lock:
+            if size <= self.max_bytes:
+                if key in self.entries:
+                    self.bytes -= self.entries.pop(key)[1]
+                self.entries[key] = (value, size)
+                self.bytes += size
+                while self.bytes > self.max_bytes:
+                    _, (_, evicted_size) = self.entries.popitem(last=False)
+                    self.bytes -= evicted_size
+                    self.evictions += 1
+        return value
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'shared_hits': self.shared_hits,
+                'evictions': self.evictions,
+            }
+
+@st.cache_resource
+
+def get_result_cache():
+    return ResultCache(result_cache_mb * 1024 * 1024, get_shared_cache())
+
+def state_version(state_key):
+    ## State keys start with the data_key, whose first item is the dataset version; callers may wrap the
+    ## state key in a tuple of their own with it first.
+    while isinstance(state_key, tuple) and state_key:
+        state_key = state_key[0]
+    return state_key
+
+def cached_result(section, state_key, compute):
+    ## Result of compute() for a page section under the filter state in state_key, shared across sessions.
+    ## state_key must identify everything the inputs of compute() were produced from: CubeView.state_key covers
+    ## the dataset version, date range and filter selections, and callers add any other inputs to it.
+    return get_result_cache().get(section, state_key, compute, state_version(state_key))
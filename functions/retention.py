@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+from functions.result_cache import cached_result
+
+## Missing times sort after every real time, so they never count as existing or retained.
+missing_time = np.iinfo(np.int64).max
+
+def time_values(times):
+    values = pd.Series(times).to_numpy(dtype='datetime64[ns]').view(np.int64).copy()
+    values[pd.isna(times)] = missing_time
+    return values
+
+class RetentionIndex:
+    ## Per customer creation time and first active line item time, built once per filtered dataset.
+    ## Customers are kept sorted by creation time, so the customers existing at T0 are a prefix found with a
+    ## binary search. Their first active times are stored as a merge sort tree (level l holds sorted runs of
+    ## 2**l customers), so the retained customers in any prefix are counted with one binary search per level.
+    def __init__(self, customer_keys, created, activity, active):
+        codes, uniques = pd.factorize(customer_keys)
+        created_values = time_values(created)
+        activity_values = np.where(np.asarray(active), time_values(activity), missing_time)
+
+        customer_created = np.full(len(uniques), missing_time, dtype=np.int64)
+        np.minimum.at(customer_created, codes, created_values)
+        first_active = np.full(len(uniques), missing_time, dtype=np.int64)
+        np.minimum.at(first_active, codes, activity_values)
+
+        order = np.argsort(customer_created, kind='stable')
+        self.created = customer_created[order]
+        self.levels = [first_active[order]]
+
+        size = 1
+        while size < len(order):
+            size *= 2
+            values = np.concatenate([self.levels[0], np.full(-len(order) % size, missing_time, dtype=np.int64)])
+            self.levels.append(np.sort(values.reshape(-1, size), axis=1).ravel())
+
+    def existing(self, start):
+        ## Number of customers created at or before start.
+        return int(np.searchsorted(self.created, pd.Timestamp(start).value, side='right'))
+
+    def retained(self, start, end):
+        ## Number of customers created at or before start with an active line item at or before end.
+        count = self.existing(start)
+        end = pd.Timestamp(end).value
+        retained = 0
+        position = 0
+        for level in range(len(self.levels) - 1, -1, -1):
+            size = 2 ** level
+            if count - position >= size:
+                retained += int(np.searchsorted(self.levels[level][position:position + size], end, side='right'))
+                position += size
+        return retained
+
+    def rate(self, start, end):
+        ## Share of the customers existing at start that are retained by end, in percent.
+        existing = self.existing(start)
+        return (self.retained(start, end) / existing) * 100 if existing > 0 else 0
+
+def get_retention_index(data, state_key):
+    return cached_result('retention_index', state_key, lambda: RetentionIndex(
+        data['customer_key'],
+        data['customer_created_at'],
+        data['created_at'],
+        (data['subscription_status'] == 'active').to_numpy()
+    ))
@@ -3,17 +3,54 @@ import plost
 import pandas as pd
 import numpy as np
 from datetime import datetime
-from functions.filters import date_filter, filter_data, setting_filters
-from functions.query import query_results
+from functions.filters import date_filter, filter_data, filter_columns, setting_filters
+from functions.query import query_results, dataset_info
+from functions.enrichment import enrich_data
+from functions.cube import CubeView
+from functions.result_cache import get_result_cache
 
-def page_creation():
-    billing_data, d = date_filter()
+def page_creation(columns=None):
+    ## In batch mode the date range and the filters sit in one form: changes are held in the browser and applied
+    ## together with one rerun, instead of one full rerun per selection.
+    batch_filters = st.toggle("Apply filter changes together", value=True, key='batch_filters')
+    filter_area = st.form('filters', border=False) if batch_filters else st.container()
 
-    ## Only generate the tiles if date range is populated
-    if d is not None and len(d) == 2:
-        start_date, end_date = d
-        if start_date is not None:
-            data_date_filtered = filter_data(start=start_date, end=end_date, data_ref=billing_data)
-            fully_filtered_data = setting_filters(data=data_date_filtered)
+    ## Push the page's columns down to the source. The date range is sliced from the cached frame,
+    ## so moving the date widget does not go back to the source.
+    if columns is not None:
+        columns = sorted(set(columns) | set(filter_columns))
 
-    return fully_filtered_data
\ No newline at end of file
+    with filter_area:
+        d = date_filter(columns)
+
+        ## Only generate the tiles if date range is populated
+        if d is not None and len(d) == 2:
+            start_date, end_date = d
+            if start_date is not None:
+                billing_data = query_results(columns=columns)
+                data_date_filtered = filter_data(start=start_date, end=end_date, data_ref=billing_data)
+                data_key = (billing_data.attrs.get('version'), start_date, end_date, tuple(billing_data.columns))
+                data_enriched = enrich_data(data_date_filtered, data_key)
+                fully_filtered_data, selections = setting_filters(data=data_enriched, data_key=data_key, batch=batch_filters)
+                cube = CubeView(data_enriched, selections, fully_filtered_data, data_key, billing_data)
+
+        if batch_filters:
+            st.form_submit_button("Apply filters")
+
+    ## The dataset is refreshed in the background; show which version is being served and how old it is.
+    info = dataset_info(columns=columns)
+    if info is not None:
+        st.sidebar.caption(
+            f"Data version {str(info['version'])[:16]}, loaded {info['age'] / 60:,.0f} min ago"
+            + (", checking for updates" if info['refreshing'] else "")
+        )
+
+    ## Section results are shared by every session on this server; show how often they are reused.
+    stats = get_result_cache().stats()
+    st.sidebar.caption(
+        f"Result cache: {stats['hits']:,} hits, {stats['misses']:,} misses ({stats['shared_hits']:,} served from the shared cache), "
+        f"{stats['entries']:,} entries, "
+        f"{stats['bytes'] / 2**20:,.0f} of {stats['max_bytes'] / 2**20:,.0f} MB"
+    )
+
+    return fully_filtered_data, cube
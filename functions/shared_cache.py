@@ -0,0 +1,122 @@
+import os
+import glob
+import stat
+import time
+import pickle
+import sqlite3
+import hashlib
+from contextlib import closing
+import streamlit as st
+import pyarrow as pa
+
+## Optional cache directory shared by every server process on the host; unset means each process keeps its own.
+shared_cache_dir = os.environ.get('BILLING_SHARED_CACHE')
+shared_cache_mb = int(os.environ.get('BILLING_SHARED_CACHE_MB', '2048'))
+
+def digest(value):
+    return hashlib.sha256(repr(value).encode()).hexdigest()
+
+class SharedCache:
+    ## Disk tier behind the in-process caches. Loaded datasets are Arrow IPC files named after the dataset version
+    ## and projection; section results are pickled into a SQLite table that every process reads and writes. Both
+    ## are keyed on the dataset version, and switching to a new version removes everything built from older ones.
+    ## Results are unpickled, so anyone who can write the directory can run code in every server process; it is
+    ## created private to the server's user, and a directory other users can write to is refused.
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.db_path = os.path.join(directory, 'results.sqlite')
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        if os.stat(directory).st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            raise PermissionError(f"Shared cache directory {directory} is writable by other users")
+        os.makedirs(os.path.join(directory, 'datasets'), mode=0o700, exist_ok=True)
+        with self.connect() as conn, conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, version TEXT, value BLOB, size INTEGER, written_at REAL)')
+
+    def connect(self):
+        ## A short lived connection per call; SQLite serializes the writers of all processes.
+        return closing(sqlite3.connect(self.db_path, timeout=30))
+
+    def dataset_path(self, version, columns, start, end):
+        return os.path.join(self.directory, 'datasets', f"{digest(version)[:16]}-{digest((columns, start, end))[:16]}.arrow")
+
+    def write_dataset(self, data, path):
+        ## Written uncompressed, so readers can map the columns straight from the file. Floats keep NaN as a value
+        ## rather than becoming nulls, which would force a copy on every read.
+        table = pa.Table.from_pandas(data, preserve_index=False)
+        for i, field in enumerate(table.schema):
+            if pa.types.is_floating(field.type):
+                table = table.set_column(i, field, pa.array(data[field.name].to_numpy(), from_pandas=False))
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with pa.OSFile(tmp_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, path)
+
+    def read_dataset(self, path):
+        ## Memory-maps the file, so every process reading it shares one copy in the OS page cache. Numeric, date
+        ## and categorical code columns without nulls are read-only views into the map; strings, category labels
+        ## and columns holding nulls are copied into the process. Removing the file later leaves open maps valid.
+        table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+        return table.to_pandas(split_blocks=True)
+
+    def get(self, key):
+        try:
+            with self.connect() as conn:
+                row = conn.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+        try:
+            return pickle.loads(row[0])
+        except Exception:
+            ## Written by an incompatible version of the app; treat as a miss and let it be overwritten.
+            return None
+
+    def put(self, key, value, version):
+        try:
+            blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return
+        if len(blob) > self.max_bytes:
+            return
+        try:
+            with self.connect() as conn, conn:
+                conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)', (key, version, blob, len(blob), time.time()))
+                ## Keep the table within its budget, dropping the oldest results first.
+                conn.execute(
+                    'DELETE FROM results WHERE key IN (SELECT key FROM '
+                    '(SELECT key, SUM(size) OVER (ORDER BY written_at DESC, key) AS kept FROM results) WHERE kept > ?)',
+                    (self.max_bytes,)
+                )
+        except sqlite3.Error:
+            ## A busy or unwritable cache only costs the other processes a recompute.
+            pass
+
+    def invalidate(self, version):
+        ## Remove results and datasets built from any version other than the current one.
+        try:
+            with self.connect() as conn, conn:
+                conn.execute('DELETE FROM results WHERE version IS NOT ?', (version,))
+        except sqlite3.Error:
+            pass
+        prefix = digest(version)[:16]
+        for path in glob.glob(os.path.join(self.directory, 'datasets', '*.arrow')):
+            if not os.path.basename(path).startswith(prefix):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+@st.cache_resource
+
+def get_shared_cache():
+    if not shared_cache_dir:
+        return None
+    try:
+        return SharedCache(shared_cache_dir, shared_cache_mb * 1024 * 1024)
+    except (OSError, sqlite3.Error):
+        ## An unwritable cache directory leaves each process with its own in-memory caches only.
+        return None
@@ -0,0 +1,43 @@
+import os
+import glob
+
+## Typed columnar copies of the source export live next to the data, one file per source version.
+snapshot_dir = os.path.join('data', '.snapshots')
+
+def snapshot_path(source_path):
+    ## The snapshot is keyed on the source's size and mtime, so any change to the export produces a new key.
+    stat = os.stat(source_path)
+    name = os.path.splitext(os.path.basename(source_path))[0]
+    return os.path.join(snapshot_dir, f"{name}-{stat.st_size}-{stat.st_mtime_ns}.parquet")
+
+def remove_stale_snapshots(source_path, keep_path):
+    name = os.path.splitext(os.path.basename(source_path))[0]
+    for path in glob.glob(os.path.join(snapshot_dir, f"{name}-*.parquet")):
+        if path != keep_path:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def write_snapshot(data, path):
+    ## Write to a temporary file first so a concurrent reader never sees a half written snapshot.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    data.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+def ensure_snapshot(source_path, read_source):
+    path = snapshot_path(source_path)
+    if os.path.exists(path):
+        return path
+
+    ## Snapshot is missing or the source changed: parse the source once and persist the typed result.
+    data = read_source(source_path)
+    try:
+        write_snapshot(data, path)
+        remove_stale_snapshots(source_path, path)
+    except OSError:
+        ## Read-only deployments get no snapshot and the caller falls back to parsing the source.
+        return None
+
+    return path
@@ -0,0 +1,152 @@
+import os
+import queue
+import sqlite3
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+import pandas as pd
+from functions.snapshot import ensure_snapshot
+
+## A source returns line item rows for a set of columns, optionally restricted to created_at in [start, end).
+## Both the projection and the date predicate are pushed into the backend rather than applied in pandas.
+
+class DataSource(ABC):
+    @abstractmethod
+    def version(self):
+        pass
+
+    @abstractmethod
+    def load(self, columns, start=None, end=None):
+        pass
+
+## A SQL table's version includes the latest value of the first of these columns it has, so rows updated in place
+## produce a new version. Without one, sums over the columns that billing updates usually touch stand in for it.
+update_columns = ['updated_at', '_fivetran_synced']
+checksum_columns = ['total_amount', 'refund_amount', 'fee_amount', 'subscription_period_ended_at']
+
+class FileSource(DataSource):
+    ## CSV exports are converted once into a Parquet snapshot; Parquet files are read directly.
+    def __init__(self, path, date_columns):
+        self.path = path
+        self.date_columns = date_columns
+
+    def read_csv(self, path):
+        return pd.read_csv(path, parse_dates=self.date_columns)
+
+    def parquet_path(self):
+        if self.path.endswith('.parquet'):
+            return self.path
+        return ensure_snapshot(self.path, self.read_csv)
+
+    def version(self):
+        stat = os.stat(self.path)
+        return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+    def load(self, columns, start=None, end=None):
+        filters = []
+        if start is not None:
+            filters.append(('created_at', '>=', start))
+        if end is not None:
+            filters.append(('created_at', '<', end))
+
+        path = self.parquet_path()
+        if path is not None:
+            return pd.read_parquet(path, columns=columns, filters=filters or None)
+
+        ## No snapshot could be written, so parse the CSV and apply the predicate in memory.
+        data = self.read_csv(self.path)
+        if start is not None:
+            data = data[data['created_at'] >= start]
+        if end is not None:
+            data = data[data['created_at'] < end]
+        return data[columns]
+
+class ConnectionPool:
+    ## Fixed size pool so concurrent sessions reuse open connections instead of reconnecting on every query.
+    def __init__(self, connect, size=4):
+        self.connect = connect
+        self.idle = queue.LifoQueue(maxsize=size)
+        self.slots = queue.Queue()
+        for _ in range(size):
+            self.slots.put(None)
+
+    @contextmanager
+    def connection(self):
+        self.slots.get()
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            conn = self.connect()
+        try:
+            yield conn
+        except Exception:
+            conn.close()
+            conn = None
+            raise
+        finally:
+            if conn is not None:
+                self.idle.put(conn)
+            self.slots.put(None)
+
+class SQLSource(DataSource):
+    ## Any DB-API connection with qmark parameters works; SQLite and DuckDB are the local stand-ins for a warehouse.
+    def __init__(self, connect, table, pool_size=4):
+        self.table = table
+        self.pool = ConnectionPool(connect, pool_size)
+        self.table_columns = None
+
+    def query(self, sql, params=()):
+        with self.pool.connection() as conn:
+            cursor = conn.execute(sql, params)
+            names = [col[0] for col in cursor.description]
+            rows = cursor.fetchall()
+        return pd.DataFrame.from_records(rows, columns=names)
+
+    def columns(self):
+        if self.table_columns is None:
+            with self.pool.connection() as conn:
+                cursor = conn.execute(f'SELECT * FROM {self.table} LIMIT 0')
+                self.table_columns = [col[0] for col in cursor.description]
+        return self.table_columns
+
+    def version(self):
+        columns = self.columns()
+        marker = [f'MAX("{col}")' for col in update_columns if col in columns][:1]
+        if not marker:
+            marker = [f'MAX("{col}")' if col.endswith('_at') else f'SUM("{col}")' for col in checksum_columns if col in columns]
+            if 'subscription_status' in columns:
+                marker.append('SUM(CASE WHEN "subscription_status" = \'active\' THEN 1 ELSE 0 END)')
+        select = ', '.join(['COUNT(*)', 'MAX("created_at")'] + marker)
+        result = self.query(f'SELECT {select} FROM {self.table}')
+        return '-'.join(str(value) for value in result.iloc[0])
+
+    def load(self, columns, start=None, end=None):
+        select = ', '.join(f'"{col}"' for col in columns)
+        where = []
+        params = []
+        if start is not None:
+            where.append('"created_at" >= ?')
+            params.append(str(pd.Timestamp(start)))
+        if end is not None:
+            where.append('"created_at" < ?')
+            params.append(str(pd.Timestamp(end)))
+
+        sql = f'SELECT {select} FROM {self.table}'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        return self.query(sql, params)
+
+def connect_sqlite(path):
+    ## Connections are handed between Streamlit script threads by the pool, never used concurrently.
+    return lambda: sqlite3.connect(path, check_same_thread=False)
+
+def connect_duckdb(path):
+    import duckdb
+    return lambda: duckdb.connect(path, read_only=True)
+
+def create_source(url, table, date_columns):
+    ## sqlite:///path.db and duckdb:///path.duckdb select a SQL backend; anything else is a CSV or Parquet file path.
+    if url.startswith('sqlite:///'):
+        return SQLSource(connect_sqlite(url[len('sqlite:///'):]), table)
+    if url.startswith('duckdb:///'):
+        return SQLSource(connect_duckdb(url[len('duckdb:///'):]), table)
+    return FileSource(url, date_columns)
@@ -7,6 +7,8 @@ import plotly.express as px
 import plotly.graph_objects as go
 from datetime import datetime
 from functions.setup_page import page_creation
+from functions.periods import period_key, period_totals
+from functions.customers import get_customer_table, format_customer_rows
 from plotly.subplots import make_subplots
 
 ## Apply standard page settings.
@@ -17,29 +19,25 @@ st.set_page_config(
 
 st.title('Orders and Revenue')
 
-## Define data and filters. The resulting data variable includes the data with all filters applied.
-data = page_creation()
+## Columns used by this page; only these (plus the filter columns) are pulled from the source.
+page_columns = ['header_id', 'created_at', 'product_name', 'total_amount', 'refund_amount', 'discount_amount', 'customer_id', 'customer_created_at', 'customer_name', 'customer_email', 'customer_city', 'customer_country']
 
-## Ensure all date columns are in datetime format
-date_columns = ['created_at', 'customer_created_at', 'payment_at', 'subscription_period_started_at', 'subscription_period_ended_at']
-for col in date_columns:
-    if col in data.columns:
-        data[col] = pd.to_datetime(data[col], errors='coerce')
+## Define data and filters. The resulting data variable includes the data with all filters applied, and cube
+## answers additive aggregates from per-dimension rollups whenever the active filters allow it.
+data, cube = page_creation(columns=page_columns)
 
 st.divider()
 
 # Calculate KPIs
-data['month'] = data['created_at'].dt.to_period('M').dt.to_timestamp()
-data['quarter'] = data['created_at'].dt.to_period('Q').dt.to_timestamp()
-
-current_year = data['created_at'].dt.year.max()
+## Date columns arrive as datetime64 with precomputed calendar keys, so no conversion is needed here.
+current_year = data['created_year'].max()
 previous_year = current_year - 1
 
-total_revenue = data['total_amount'].sum()
-number_of_orders = data['header_id'].nunique()
-number_of_customers = data['customer_id'].nunique()
-min_created_at = data['created_at'].min()
-max_created_at = data['created_at'].max()
+total_revenue = cube.sum(measure='total_amount')
+number_of_orders = data['header_key'].nunique()
+number_of_customers = data['customer_key'].nunique()
+min_created_at = data['created_at'].min().normalize()
+max_created_at = data['created_at'].max().normalize()
 new_customers = data[(data['customer_created_at'] >= min_created_at) & (data['customer_created_at'] <= max_created_at)].shape[0]
 
 # Helper function to calculate percentage change
@@ -47,25 +45,21 @@ def percentage_change(current, previous):
     return ((current - previous) / previous * 100) if previous != 0 else float('inf')
 
 # Calculate percentage changes for YoY
+revenue_by_year = cube.sum('created_year', 'total_amount')
 total_revenue_yoy = percentage_change(
-    data[data['created_at'].dt.year == current_year]['total_amount'].sum(),
-    data[data['created_at'].dt.year == previous_year]['total_amount'].sum()
+    revenue_by_year.get(current_year, 0),
+    revenue_by_year.get(previous_year, 0)
 )
 
-number_of_orders_yoy = percentage_change(
-    data[data['created_at'].dt.year == current_year]['header_id'].nunique(),
-    data[data['created_at'].dt.year == previous_year]['header_id'].nunique()
-)
+## Orders and customers per year, and new customers per sign-up year, each from one grouped pass.
+yearly = period_totals(data, 'created_year', [current_year, previous_year], distinct=['header_key', 'customer_key'])
+signups = period_totals(data, period_key(data['customer_created_at']), [current_year, previous_year])
 
-number_of_customers_yoy = percentage_change(
-    data[data['created_at'].dt.year == current_year]['customer_id'].nunique(),
-    data[data['created_at'].dt.year == previous_year]['customer_id'].nunique()
-)
+number_of_orders_yoy = percentage_change(*yearly['header_key'])
 
-new_customers_yoy = percentage_change(
-    data[data['customer_created_at'].dt.year == current_year].shape[0],
-    data[data['customer_created_at'].dt.year == previous_year].shape[0]
-)
+number_of_customers_yoy = percentage_change(*yearly['customer_key'])
+
+new_customers_yoy = percentage_change(*signups['rows'])
 
 # KPI Metrics
 with st.container():
@@ -89,8 +83,6 @@ with st.container():
         
 
 # Time series charts
-data['month'] = data['created_at'].dt.to_period('M').dt.to_timestamp()
-
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import streamlit as st
@@ -98,16 +90,16 @@ import streamlit as st
 with st.container():
     # Revenue and Orders chart (full width)
     st.markdown("**Total Revenue and Orders Over Time**")
-    revenue_over_time = data.groupby('month')['total_amount'].sum().reset_index()
-    orders_over_time = data.groupby('month')['header_id'].nunique().reset_index()
-    combined_data = revenue_over_time.merge(orders_over_time, on='month')
+    revenue_over_time = cube.sum('created_month', 'total_amount').reset_index()
+    orders_over_time = data.groupby('created_month')['header_key'].nunique().reset_index()
+    combined_data = revenue_over_time.merge(orders_over_time, on='created_month')
     
     fig = make_subplots(specs=[[{"secondary_y": True}]])
     
     # Add revenue bars
     fig.add_trace(
         go.Bar(
-            x=combined_data['month'],
+            x=combined_data['created_month'],
             y=combined_data['total_amount'],
             name='Revenue',
             text=combined_data['total_amount'].apply(lambda x: f'${x:,.0f}'),
@@ -121,11 +113,11 @@ with st.container():
     # Add orders line
     fig.add_trace(
         go.Scatter(
-            x=combined_data['month'],
-            y=combined_data['header_id'],
+            x=combined_data['created_month'],
+            y=combined_data['header_key'],
             name='Orders',
             mode='lines+markers+text',
-            text=combined_data['header_id'].astype(str),
+            text=combined_data['header_key'].astype(str),
             textposition='top center',
             textfont=dict(size=10, color='#ff7f0e'),
             line=dict(color='#ff7f0e', width=3),  # Orange color for orders line
@@ -158,7 +150,7 @@ with st.container():
     
     # Adjust the y-axis range for Orders to reduce overlap
     max_revenue = combined_data['total_amount'].max()
-    max_orders = combined_data['header_id'].max()
+    max_orders = combined_data['header_key'].max()
     revenue_order_ratio = max_revenue / max_orders
     
     fig.update_yaxes(
@@ -182,7 +174,7 @@ with st.container():
     
 with col1:
     st.markdown("**Product By Revenue**")
-    product_revenue = data.groupby('product_name')['total_amount'].sum().reset_index()
+    product_revenue = cube.sum('product_name', 'total_amount').reset_index()
     product_revenue = product_revenue.sort_values(by='total_amount', ascending=False)  # Changed to descending order
 
     # Create the figure manually with a blue gradient
@@ -228,16 +220,16 @@ with col1:
         filtered_data = data[(data['customer_created_at'] >= min_created_at) & (data['customer_created_at'] <= max_created_at)]
         
         filtered_data['customer_created_month'] = filtered_data['customer_created_at'].dt.to_period('M').dt.to_timestamp()
-        new_customers_over_time = filtered_data.groupby('customer_created_month')['customer_id'].nunique().reset_index()
+        new_customers_over_time = filtered_data.groupby('customer_created_month')['customer_key'].nunique().reset_index()
         
         fig = px.bar(new_customers_over_time, 
                     x='customer_created_month', 
-                    y='customer_id',
+                    y='customer_key',
                     color_discrete_sequence=['#1f77b4'])  # Changed to blue
         
-        fig.update_yaxes(title_text='New Customers', range=[0, new_customers_over_time['customer_id'].max() * 1.1])
+        fig.update_yaxes(title_text='New Customers', range=[0, new_customers_over_time['customer_key'].max() * 1.1])
         fig.update_xaxes(title_text='Month', tickformat='%b %Y')
-        fig.update_traces(text=new_customers_over_time['customer_id'], textposition='outside')
+        fig.update_traces(text=new_customers_over_time['customer_key'], textposition='outside')
         
         # Ensure x-axis range matches the filter
         fig.update_xaxes(range=[min_created_at, max_created_at])
@@ -252,7 +244,7 @@ with col1:
 
 # Location Performance Chart
 # Aggregate revenue by customer_country
-location_performance = data.groupby('customer_country')['total_amount'].sum().reset_index()
+location_performance = cube.sum('customer_country', 'total_amount').reset_index()
 
 # Sort by total_amount in descending order
 location_performance = location_performance.sort_values(by='total_amount', ascending=False)
@@ -299,87 +291,50 @@ st.plotly_chart(fig, use_container_width=True)
 # Customer Table
 
 
-# Display the title above the filters
-st.markdown("**Enhanced Customer Table**")
+## The table runs as a fragment: its search, sort and paging widgets rerun only this section, against the cached
+## customer summary, instead of the filters, KPIs and charts above.
+@st.fragment
+def customer_table_section(data, state_key):
+    # Customer summary for the filtered line items, cached per dataset, date range and filter selections
+    customer_table = get_customer_table(data, state_key)
 
-# Create two columns for the filter inputs
-col1, col2 = st.columns([1, 1])
+    # Create two columns for the search inputs
+    col1, col2 = st.columns([1, 1])
 
-# Place the filters in these columns
-with col1:
-    # Create a list of unique customer names for the multiselect
-    name_filter = st.multiselect(
-        "Filter by Customer Name",
-        options=data['customer_name'].unique(),
-        default=None
-    )
+    # Names and emails are searched by prefix on the server rather than sent to the browser as options
+    with col1:
+        name_search = st.text_input("Search by Customer Name", placeholder="Name starts with...")
+
+    with col2:
+        email_search = st.text_input("Search by Customer Email", placeholder="Email starts with...")
+
+    # Sorting and paging controls
+    col1, col2, col3, col4 = st.columns([2, 1, 1, 1])
+
+    with col1:
+        sort_by = st.selectbox("Sort by", options=['None'] + list(customer_table.table.columns))
+
+    with col2:
+        sort_order = st.selectbox("Order", options=['Ascending', 'Descending'])
 
-with col2:
-    # Create a list of unique customer emails for the multiselect
-    email_filter = st.multiselect(
-        "Filter by Customer Email",
-        options=data['customer_email'].unique(),
-        default=None
+    with col3:
+        page_size = st.selectbox("Rows per page", options=[25, 50, 100, 250], index=1)
+
+    positions = customer_table.select(
+        searches={'Name': name_search, 'Email': email_search},
+        sort_by=None if sort_by == 'None' else sort_by,
+        ascending=sort_order == 'Ascending'
     )
+    page_count = max(1, -(-len(positions) // page_size))
+
+    with col4:
+        page = st.number_input("Page", min_value=1, max_value=page_count, value=1, step=1)
 
-# Calculate Total Spend
-total_spend = data.groupby('customer_id')['total_amount'].sum().reset_index()
-
-# Calculate Total Orders
-total_orders = data.groupby('customer_id')['header_id'].nunique().reset_index()
-total_orders.rename(columns={'header_id': 'total_orders'}, inplace=True)
-
-# Calculate Total Refunds
-total_refunds = data.groupby('customer_id')['refund_amount'].sum().reset_index()
-
-# Calculate Total Discounts
-total_discounts = data.groupby('customer_id')['discount_amount'].sum().reset_index()
-
-# Calculate Last Order Date
-last_order_date = data.groupby('customer_id')['created_at'].max().reset_index()
-
-# Calculate Created Date
-created_date = data.groupby('customer_id')['customer_created_at'].min().reset_index()
-
-# Merge all the calculated fields
-filtered_customer_table = data[['customer_id', 'customer_name', 'customer_email', 'customer_city', 'customer_country']].drop_duplicates().reset_index(drop=True)
-filtered_customer_table = filtered_customer_table.merge(total_spend, on='customer_id', how='left')
-filtered_customer_table = filtered_customer_table.merge(total_orders, on='customer_id', how='left')
-filtered_customer_table = filtered_customer_table.merge(total_refunds, on='customer_id', how='left')
-filtered_customer_table = filtered_customer_table.merge(total_discounts, on='customer_id', how='left')
-filtered_customer_table = filtered_customer_table.merge(last_order_date, on='customer_id', how='left')
-filtered_customer_table = filtered_customer_table.merge(created_date, on='customer_id', how='left')
-
-# Rename columns
-filtered_customer_table.rename(columns={
-    'customer_id': 'ID',
-    'customer_name': 'Name',
-    'customer_email': 'Email',
-    'customer_city': 'City',
-    'customer_country': 'Country',
-    'total_amount': 'Total Spend',
-    'refund_amount': 'Total Refunds',
-    'discount_amount': 'Total Discounts',
-    'created_at': 'Last Order Date',
-    'customer_created_at': 'Created Date',
-}, inplace=True)
-
-# Apply filters to the customer table
-if name_filter:
-    filtered_customer_table = filtered_customer_table[filtered_customer_table['Name'].isin(name_filter)]
-if email_filter:
-    filtered_customer_table = filtered_customer_table[filtered_customer_table['Email'].isin(email_filter)]
-
-
-# Format dollar columns
-filtered_customer_table['Total Spend'] = filtered_customer_table['Total Spend'].apply(lambda x: f"${x:,.2f}")
-filtered_customer_table['Total Refunds'] = filtered_customer_table['Total Refunds'].apply(lambda x: f"${x:,.2f}")
-filtered_customer_table['Total Discounts'] = filtered_customer_table['Total Discounts'].apply(lambda x: f"${x:,.2f}")
-
-# Format date columns
-filtered_customer_table['Last Order Date'] = pd.to_datetime(filtered_customer_table['Last Order Date']).dt.strftime('%Y-%m-%d')
-filtered_customer_table['Created Date'] = pd.to_datetime(filtered_customer_table['Created Date']).dt.strftime('%Y-%m-%d')
-
-# Display the customer table
-st.dataframe(filtered_customer_table)
+    # Only the visible page is formatted and sent to the browser
+    page_rows = customer_table.page(positions, page, page_size)
+    st.dataframe(format_customer_rows(page_rows))
+    st.caption(f"Showing {len(page_rows):,} of {len(positions):,} customers (page {page} of {page_count})")
 
+# Display the title above the filters
+st.markdown("**Enhanced Customer Table**")
+customer_table_section(data, cube.state_key)
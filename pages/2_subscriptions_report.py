@@ -3,6 +3,9 @@ import pandas as pd
 import numpy as np
 from datetime import datetime
 from functions.setup_page import page_creation
+from functions.periods import period_key, period_totals
+from functions.mrr import get_mrr_ledger, mrr_at
+from functions.intervals import get_active_subscriptions
 import plotly.express as px
 
 ## Apply standard page settings.
@@ -13,8 +16,12 @@ st.set_page_config(
 
 st.title('Subscriptions Report')
 
-## Define data and filters. The resulting data variable includes the data with all filters applied.
-data = page_creation()
+## Columns used by this page; only these (plus the filter columns) are pulled from the source.
+page_columns = ['created_at', 'transaction_type', 'billing_type', 'product_type', 'total_amount', 'payment_at', 'subscription_id', 'subscription_plan', 'subscription_period_started_at', 'subscription_period_ended_at', 'subscription_status']
+
+## Define data and filters. The resulting data variable includes the data with all filters applied, and cube
+## answers additive aggregates from per-dimension rollups whenever the active filters allow it.
+data, cube = page_creation(columns=page_columns)
 
 st.divider()
 
@@ -22,16 +29,10 @@ st.divider()
 # The framework has been set, but no visualization or data processing has been applied.
 # Please perform any data processing in this file and not within the filter files. We can discuss upon completion if it makes sense to add any code to the filters file.
 
-# Find the min and max of the created_at column
-min_date = pd.to_datetime(data['created_at']).dt.to_period('M').min()
-max_date = pd.to_datetime(data['created_at']).dt.to_period('M').max()
-
-# Convert payment_at to datetime
-data.loc[:, 'payment_at'] = pd.to_datetime(data['payment_at'])
-data['payment_month'] = data['payment_at'].dt.to_period('M')
-data['payment_year'] = data['payment_at'].dt.to_period('Q')
-data['subscription_started_month'] = data['subscription_period_started_at'].dt.to_period('M')
-data['subscription_started_year'] = data['subscription_period_started_at'].dt.to_period('Q')
+# Find the min and max month of the created_at column
+## payment_month and subscription_started_month are precomputed month start keys from the loader.
+min_date = data['created_month'].min()
+max_date = data['created_month'].max()
 
 # Filter the Dataframe to include only 'subscription' and 'recurring' billing types
 subscriptions_data = data[
@@ -42,12 +43,6 @@ subscriptions_data = data[
 # Add length of subscriptions in weeks
 subscriptions_data['subscription_length_weeks'] = (subscriptions_data['subscription_period_ended_at'] - subscriptions_data['subscription_period_started_at']).dt.days / 7
 
-# Filter so payment_month is within the date range
-subscriptions_revenue_data = subscriptions_data[
-    (subscriptions_data['payment_month'] >= min_date) &
-    (subscriptions_data['payment_month'] <= max_date)
-]
-
 # Filter the Dataframe to include only 'one-time' and 'invoiceitem' billing types
 onetime_data = data[
     (data['billing_type'].isin(['one-time', 'invoiceitem'])) & 
@@ -67,8 +62,12 @@ subscriptions_starts_data = subscriptions_data[
 new_subscriptions_data = subscriptions_starts_data[subscriptions_starts_data['subscription_status'] == 'active']
 
 # Group by 'payment_month' to calculate MRR and single order
-mrr_data = subscriptions_data.groupby(subscriptions_data['payment_month'])['total_amount'].sum().sort_index()
-single_order_data = onetime_data.groupby(onetime_data['payment_month'])['total_amount'].sum().sort_index()
+## Revenue sums come from the rollups; the same conditions as subscriptions_data and onetime_data apply.
+subscription_sales = {'billing_type': ['subscription', 'recurring'], 'transaction_type': ['sale']}
+onetime_sales = {'billing_type': ['one-time', 'invoiceitem'], 'transaction_type': ['sale']}
+subscription_revenue_by_month = cube.sum('payment_month', 'total_amount', where=subscription_sales).sort_index()
+mrr_data = subscription_revenue_by_month
+single_order_data = cube.sum('payment_month', 'total_amount', where=onetime_sales).sort_index()
 
 # Filter to be within the min_date and max_date
 mrr_data = mrr_data[
@@ -86,10 +85,10 @@ with st.container():
 
     # Total Revenue From Subscriptions
     with col1:
-        current_total_revenue = subscriptions_data['total_amount'].sum()
-        last_year_total_revenue = subscriptions_data[
-            subscriptions_data['payment_month'].dt.year == ((max_date.year - 1))
-            ]['total_amount'].sum()
+        current_total_revenue = cube.sum(measure='total_amount', where=subscription_sales)
+        last_year_total_revenue = subscription_revenue_by_month[
+            subscription_revenue_by_month.index.year == ((max_date.year - 1))
+            ].sum()
         current_total_revenue_str = f'${current_total_revenue:,.2f}' if not pd.isna(current_total_revenue) else "no data"
         yoy_total_revenue = current_total_revenue - last_year_total_revenue
         yoy_total_revenue_str = f'{yoy_total_revenue:,.2f} YoY' if not pd.isna(yoy_total_revenue) else "no data"
@@ -103,9 +102,10 @@ with st.container():
     with col2:
         current_active_subscriptions = active_subscriptions_data['subscription_status'].count()
         current_active_subscriptions_str = f'{current_active_subscriptions}' if not pd.isna(current_active_subscriptions) else "no data"
-        last_year_active_subscriptions = active_subscriptions_data[
-            (active_subscriptions_data['payment_month'].dt.year == (max_date.year - 1))
-        ]['subscription_status'].count()
+        last_year_active_subscriptions = period_totals(
+            active_subscriptions_data, period_key(active_subscriptions_data['payment_month']), [max_date.year - 1],
+            counts=['subscription_status']
+        )['subscription_status'].iloc[0]
         yoy_active_subscriptions = current_active_subscriptions - last_year_active_subscriptions
         yoy_active_subscriptions_str = f'{yoy_active_subscriptions:,.0f} YoY' if not pd.isna(yoy_active_subscriptions) else "no data"
         st.metric(
@@ -118,9 +118,10 @@ with st.container():
     with col3:
         current_new_subscriptions = new_subscriptions_data['subscription_status'].count()
         current_new_subscriptions_str =  f'{current_new_subscriptions}' if not pd.isna(current_new_subscriptions) else "no data"
-        last_year_new_subscriptions = new_subscriptions_data[
-            new_subscriptions_data['payment_month'].dt.year == (max_date.year - 1)
-        ]['subscription_status'].count()
+        last_year_new_subscriptions = period_totals(
+            new_subscriptions_data, period_key(new_subscriptions_data['payment_month']), [max_date.year - 1],
+            counts=['subscription_status']
+        )['subscription_status'].iloc[0]
         yoy_new_subscriptions = current_new_subscriptions - last_year_new_subscriptions
         yoy_new_subscriptions_str = f'{yoy_new_subscriptions:,.0f} YoY' if not pd.isna(yoy_new_subscriptions) else "no data"
         st.metric(
@@ -150,9 +151,11 @@ with st.container():
 
     # Most Recent Month MRR
     with col5:
-        most_recent_mrr = mrr_data.iloc[-1] if not mrr_data.empty else 0
+        ## MRR balance of the subscription ledger in the latest month, against twelve months earlier.
+        _, mrr_by_month = get_mrr_ledger(data, cube.state_key)
+        most_recent_mrr = mrr_at(mrr_by_month, max_date)
         most_recent_mrr_str = f"${most_recent_mrr:,.2f}" if not pd.isna(most_recent_mrr) else "no data"
-        last_year_mrr = mrr_data.shift(12).iloc[-1] if not mrr_data.shift(12).empty else np.nan
+        last_year_mrr = mrr_at(mrr_by_month, max_date - pd.DateOffset(years=1))
         yoy_mrr = most_recent_mrr - last_year_mrr
         yoy_mrr_str = f"{yoy_mrr:,.2f} YoY" if not pd.isna(yoy_mrr) else "no data"
         st.metric(
@@ -180,9 +183,6 @@ with st.container():
 
         new_subscriptions_by_month = new_subscriptions_data.groupby('subscription_started_month').size()
 
-        # Convert PeriodIndex to timestamp for better x-axis formatting
-        new_subscriptions_by_month.index = new_subscriptions_by_month.index.to_timestamp()
-
         # Convert Series to DataFrame
         new_subscriptions_by_month = new_subscriptions_by_month.reset_index(name='count')
         new_subscriptions_by_month.rename(columns={'index': 'subscription_started_month'}, inplace=True)
@@ -209,11 +209,8 @@ with st.container():
         st.markdown("**Number of New Subscriptions by Plan**")
         
         # Group by 'subscription_month' and 'subscription_plan'
-        subscription_by_plan = new_subscriptions_data.groupby(['subscription_started_month', 'subscription_plan']).size().unstack(fill_value=0)
+        subscription_by_plan = new_subscriptions_data.groupby(['subscription_started_month', 'subscription_plan'], observed=True).size().unstack(fill_value=0)
         
-        # Convert PeriodIndex to datetime for better x-axis formatting
-        subscription_by_plan.index = subscription_by_plan.index.to_timestamp()
-
         # Convert DataFrame for plotting
         subscription_by_plan_df = subscription_by_plan.reset_index()
         subscription_by_plan_df = pd.melt(subscription_by_plan_df, id_vars=['subscription_started_month'], var_name='subscription_plan', value_name='count')
@@ -241,11 +238,11 @@ with st.container():
         st.markdown("**Subscription Revenue by Product Type**")
 
         # Group by 'subscription_month' and 'product_type', then sum total_amount
-        revenue_by_product_type = subscriptions_revenue_data.groupby(['payment_month', 'product_type'])['total_amount'].sum().unstack(fill_value=0)
+        # Filter so payment_month is within the date range
+        revenue_by_product_type = cube.sum(['payment_month', 'product_type'], 'total_amount', where=subscription_sales)
+        payment_months = revenue_by_product_type.index.get_level_values('payment_month')
+        revenue_by_product_type = revenue_by_product_type[(payment_months >= min_date) & (payment_months <= max_date)].unstack(fill_value=0)
         
-        # Convert PeriodIndex to datetime for better x-axis formatting
-        revenue_by_product_type.index = revenue_by_product_type.index.to_timestamp()
-
         # Convert DataFrame for plotting
         revenue_by_product_type_df = revenue_by_product_type.reset_index()
         revenue_by_product_type_df = pd.melt(revenue_by_product_type_df, id_vars=['payment_month'], var_name='product_type', value_name='total_amount')
@@ -272,10 +269,6 @@ with st.container():
     with row2_col2:
         st.markdown("**Subscription Revenue vs. Single Order Revenue**")
 
-        # Convert PeriodIndex to datetime for better x-axis formatting
-        mrr_data.index = mrr_data.index.to_timestamp()
-        single_order_data.index = single_order_data.index.to_timestamp()
-
         # Align the data by reindexing both Series to have the same index
         combined_index = mrr_data.index.union(single_order_data.index)
         mrr_data = mrr_data.reindex(combined_index, fill_value=0)
@@ -310,4 +303,28 @@ with st.container():
         # Streamlit plot chart
         st.plotly_chart(fig4)
 
+    st.markdown("**Active Subscriptions Over Time**")
+
+    ## Subscriptions whose period covers the end of each month, from an interval index over the filtered rows.
+    active_by_month = get_active_subscriptions(data, cube.state_key).active_by_month(pd.date_range(min_date, max_date, freq='MS'))
+    active_by_month_df = active_by_month.rename_axis('month').reset_index(name='count')
+
+    # Create a Plotly line chart
+    fig5 = px.line(
+        active_by_month_df,
+        x='month',
+        y='count',
+        markers=True,
+        color_discrete_sequence=color_sequence
+    )
+
+    # Suppress x and y labels
+    fig5.update_layout(
+        xaxis_title='',
+        yaxis_title=''
+    )
+
+    # Streamlit plot chart
+    st.plotly_chart(fig5, use_container_width=True)
+
 st.divider()
\ No newline at end of file
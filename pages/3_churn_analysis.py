@@ -4,6 +4,12 @@ import pandas as pd
 import numpy as np
 from datetime import datetime
 from functions.setup_page import page_creation
+from functions.cube import line_item_mrr
+from functions.mrr import get_mrr_ledger, mrr_at
+from functions.retention import get_retention_index
+from functions.churn import churn_rates
+from functions.result_cache import cached_result
+from functions.cohorts import cohort_views, get_cohort_matrix, cohort_labels, cohort_colors
 import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
@@ -16,27 +22,28 @@ st.set_page_config(
 
 st.title('Churn Analysis')
 
-## Define data and filters. The resulting data variable includes the data with all filters applied.
-data = page_creation()
+## Columns used by this page; only these (plus the filter columns) are pulled from the source.
+page_columns = ['created_at', 'billing_type', 'product_type', 'total_amount', 'subscription_id', 'subscription_plan', 'subscription_period_started_at', 'subscription_period_ended_at', 'subscription_status', 'customer_id', 'customer_created_at']
+
+## Define data and filters. The resulting data variable includes the data with all filters applied, and cube
+## answers additive aggregates from per-dimension rollups whenever the active filters allow it.
+data, cube = page_creation(columns=page_columns)
 
 st.divider()
 
 # Data processing
-data['created_at'] = pd.to_datetime(data['created_at'])
-data['customer_created_at'] = pd.to_datetime(data['customer_created_at'])
-data['subscription_period_started_at'] = pd.to_datetime(data['subscription_period_started_at'])
-data['subscription_period_ended_at'] = pd.to_datetime(data['subscription_period_ended_at'])
+## Date columns arrive as datetime64 with precomputed calendar keys, so no conversion is needed here.
+# Calculate line item MRR (Monthly Recurring Revenue), for breakdowns the cube cannot answer
+data['mrr'] = line_item_mrr(data)
 
-# Calculate MRR (Monthly Recurring Revenue)
-data['mrr'] = data['total_amount'] / ((data['subscription_period_ended_at'] - data['subscription_period_started_at']).dt.days / 30)
+# MRR balance and new / expansion / contraction / churn movements per month
+mrr_movements, mrr_by_month = get_mrr_ledger(data, cube.state_key)
+mrr_by_year = mrr_by_month.groupby(mrr_by_month.index.year)[['new', 'churn']].sum()
 
 # YoY calculations
-data['month'] = data['created_at'].dt.to_period('M').dt.to_timestamp()
-data['quarter'] = data['created_at'].dt.to_period('Q').dt.to_timestamp()
-
-current_year = data['created_at'].dt.year.max()
+current_year = data['created_year'].max()
 previous_year = current_year - 1
-current_month = data['month'].max()
+current_month = data['created_month'].max()
 
 def percentage_change(current, previous):
     if previous == 0:
@@ -50,49 +57,31 @@ def format_yoy_change(change):
     else:
         return f"{change:.1f}% YoY"
 # MRR calculation
-current_mrr = data[data['subscription_status'] == 'active']['mrr'].sum()
-current_mrr_yoy = percentage_change(
-    data[(data['created_at'].dt.year == current_year) & (data['subscription_status'] == 'active')]['mrr'].sum(),
-    data[(data['created_at'].dt.year == previous_year) & (data['subscription_status'] == 'active')]['mrr'].sum()
-)
+## MRR at the latest month in the data, against the balance twelve months earlier.
+current_mrr = mrr_at(mrr_by_month, current_month)
+current_mrr_yoy = percentage_change(current_mrr, mrr_at(mrr_by_month, current_month - pd.DateOffset(years=1)))
 
 # New MRR calculations
-new_mrr = data[(data['created_at'] >= current_month) & (data['billing_type'] == 'recurring')]['mrr'].sum()
-new_mrr_yoy = percentage_change(
-    data[(data['created_at'].dt.year == current_year) & (data['billing_type'] == 'recurring')]['mrr'].sum(),
-    data[(data['created_at'].dt.year == previous_year) & (data['billing_type'] == 'recurring')]['mrr'].sum()
-)
+new_mrr = mrr_at(mrr_by_month, current_month, 'new')
+new_mrr_yoy = percentage_change(mrr_by_year['new'].get(current_year, 0), mrr_by_year['new'].get(previous_year, 0))
 
 # Churned MRR calculations
-churned_mrr = data[(data['subscription_status'] == 'inactive') & (data['subscription_period_ended_at'] >= current_month)]['mrr'].sum()
-churned_mrr_yoy = percentage_change(
-    data[(data['subscription_status'] == 'inactive') & (data['subscription_period_ended_at'].dt.year == current_year)]['mrr'].sum(),
-    data[(data['subscription_status'] == 'inactive') & (data['subscription_period_ended_at'].dt.year == previous_year)]['mrr'].sum()
-)
+churned_mrr = -mrr_at(mrr_by_month, current_month, 'churn') + 0.0
+churned_mrr_yoy = percentage_change(-mrr_by_year['churn'].get(current_year, 0), -mrr_by_year['churn'].get(previous_year, 0))
 
 # Retention rate calculations
-def calculate_retention_rate(period_start, period_end):
-    customers_at_start = data[data['customer_created_at'] <= period_start]['customer_id'].nunique()
-    customers_retained = data[(data['customer_created_at'] <= period_start) & (data['subscription_status'] == 'active') & (data['created_at'] <= period_end)]['customer_id'].nunique()
-    return (customers_retained / customers_at_start) * 100 if customers_at_start > 0 else 0
-
-retention_30_day = calculate_retention_rate(current_month - pd.DateOffset(days=30), current_month)
-retention_30_day_yoy = percentage_change(
-    calculate_retention_rate(current_month - pd.DateOffset(days=30), current_month),
-    calculate_retention_rate(current_month - pd.DateOffset(years=1, days=30), current_month - pd.DateOffset(years=1))
-)
+## Customers existing at the start of a window and retained by its end are counted from a per customer index
+## built once per filtered dataset, so each window below is a few binary searches rather than two full scans.
+retention = get_retention_index(data, cube.state_key)
 
-retention_90_day = calculate_retention_rate(current_month - pd.DateOffset(days=90), current_month)
-retention_90_day_yoy = percentage_change(
-    calculate_retention_rate(current_month - pd.DateOffset(days=90), current_month),
-    calculate_retention_rate(current_month - pd.DateOffset(years=1, days=90), current_month - pd.DateOffset(years=1))
-)
+def retention_with_yoy(window):
+    rate = retention.rate(current_month - window, current_month)
+    previous_rate = retention.rate(current_month - pd.DateOffset(years=1) - window, current_month - pd.DateOffset(years=1))
+    return rate, percentage_change(rate, previous_rate)
 
-retention_1_year = calculate_retention_rate(current_month - pd.DateOffset(years=1), current_month)
-retention_1_year_yoy = percentage_change(
-    calculate_retention_rate(current_month - pd.DateOffset(years=1), current_month),
-    calculate_retention_rate(current_month - pd.DateOffset(years=2), current_month - pd.DateOffset(years=1))
-)
+retention_30_day, retention_30_day_yoy = retention_with_yoy(pd.DateOffset(days=30))
+retention_90_day, retention_90_day_yoy = retention_with_yoy(pd.DateOffset(days=90))
+retention_1_year, retention_1_year_yoy = retention_with_yoy(pd.DateOffset(years=1))
 
 # KPI Metrics
 with st.container():
@@ -134,25 +123,28 @@ with st.container():
         st.metric(label="**1 Year Retention Rate**", value=f"{retention_1_year:.2f}%",
                   delta=format_yoy_change(retention_1_year_yoy))
 
-# Combined Churn Rate Chart
-st.markdown("**Churn Rate Over Time**")
+# Custom retention window
+## A fragment, so changing the window reruns only this tile against the cached retention index.
+@st.fragment
+def custom_retention_section():
+    col1, col2 = st.columns([1, 5])
 
-# Filter data to include only records with a subscription_id
-subscribed_data = data[data['subscription_id'].notna()]
+    with col1:
+        custom_window_days = st.number_input("Custom retention window (days)", min_value=1, value=180, step=1)
 
-# Calculate overall churn rate
-churn_rate = subscribed_data.groupby(subscribed_data['created_at'].dt.to_period('M')).apply(
-    lambda x: x[x['subscription_status'] == 'inactive']['customer_id'].nunique() / x['customer_id'].nunique()
-).reset_index()
-churn_rate.columns = ['Month', 'Overall Churn Rate']
-churn_rate['Month'] = churn_rate['Month'].dt.to_timestamp()
+    with col2:
+        retention_custom, retention_custom_yoy = retention_with_yoy(pd.DateOffset(days=custom_window_days))
+        st.metric(label=f"**{custom_window_days} Day Retention Rate**", value=f"{retention_custom:.2f}%",
+                  delta=format_yoy_change(retention_custom_yoy))
 
-# Calculate churn rate by plan
-churn_rate_by_plan = subscribed_data.groupby(['subscription_plan', subscribed_data['created_at'].dt.to_period('M')]).apply(
-    lambda x: x[x['subscription_status'] == 'inactive']['customer_id'].nunique() / x['customer_id'].nunique()
-).reset_index()
-churn_rate_by_plan.columns = ['Subscription Plan', 'Month', 'Churn Rate']
-churn_rate_by_plan['Month'] = churn_rate_by_plan['Month'].dt.to_timestamp()
+with st.container():
+    custom_retention_section()
+
+# Combined Churn Rate Chart
+st.markdown("**Churn Rate Over Time**")
+
+# Calculate the overall churn rate and the churn rate by plan, for records with a subscription_id
+churn_rate, churn_rate_by_plan = cached_result('churn_rates', cube.state_key, lambda: churn_rates(data))
 
 fig = go.Figure()
 
@@ -202,11 +194,10 @@ st.plotly_chart(fig)
 st.markdown("**New MRR by Product and Overall New MRR**")
 
 # Filter for recurring billing type and group by month and product type
-new_mrr_by_type = data[data['billing_type'] == 'recurring'].groupby([data['created_at'].dt.to_period('M'), 'product_type'])['mrr'].sum().reset_index()
-new_mrr_by_type['created_at'] = new_mrr_by_type['created_at'].dt.to_timestamp()
+new_mrr_by_type = cube.sum(['created_month', 'product_type'], 'mrr', where={'billing_type': ['recurring']}).reset_index()
 
 # Calculate overall new MRR by month
-overall_new_mrr = new_mrr_by_type.groupby('created_at')['mrr'].sum().reset_index()
+overall_new_mrr = new_mrr_by_type.groupby('created_month')['mrr'].sum().reset_index()
 
 # Create figure
 fig = go.Figure()
@@ -216,7 +207,7 @@ for product in new_mrr_by_type['product_type'].unique():
     product_data = new_mrr_by_type[new_mrr_by_type['product_type'] == product]
     fig.add_trace(
         go.Bar(
-            x=product_data['created_at'], 
+            x=product_data['created_month'], 
             y=product_data['mrr'], 
             name=product,
             text=product_data['mrr'].apply(lambda x: f'${x:,.0f}'),
@@ -227,7 +218,7 @@ for product in new_mrr_by_type['product_type'].unique():
 # Add line chart for overall new MRR
 fig.add_trace(
     go.Scatter(
-        x=overall_new_mrr['created_at'], 
+        x=overall_new_mrr['created_month'], 
         y=overall_new_mrr['mrr'], 
         name='Overall New MRR',
         line=dict(color='black', width=3),
@@ -254,13 +245,55 @@ fig.update_layout(
 st.plotly_chart(fig, use_container_width=True)
 
 
+## MRR Movements
+
+st.markdown("**MRR Movements**")
+
+# Stacked movements per month with the MRR balance, over the months in the selected date range
+movement_colors = {'new': '#306BEA', 'expansion': '#85B4FF', 'contraction': '#DB6645', 'churn': '#1E0C09'}
+mrr_range = mrr_by_month[(mrr_by_month.index >= data['created_month'].min()) & (mrr_by_month.index <= current_month)]
+
+fig = go.Figure()
+
+for movement, color in movement_colors.items():
+    fig.add_trace(
+        go.Bar(
+            x=mrr_range.index,
+            y=mrr_range[movement],
+            name=movement.capitalize(),
+            marker_color=color
+        )
+    )
+
+fig.add_trace(
+    go.Scatter(
+        x=mrr_range.index,
+        y=mrr_range['mrr'],
+        name='MRR',
+        line=dict(color='black', width=3),
+        mode='lines+markers'
+    )
+)
+
+fig.update_layout(
+    barmode='relative',
+    xaxis_title='Month',
+    yaxis_title='MRR',
+    hovermode='x unified',
+    legend=dict(orientation='h', yanchor='bottom', y=1.02, xanchor='right', x=1),
+    yaxis=dict(tickprefix='$', tickformat=',.0f')
+)
+
+st.plotly_chart(fig, use_container_width=True)
+
+
 
 
 ## Cohort Analysis Chart
 st.markdown("**Cohort Analysis - Subscription Churn Rate**")
 
 # Filter data to include only records with a subscription_id and within the date range
-start_date, end_date = st.session_state.get('date_range', (data['created_at'].min(), data['created_at'].max()))
+start_date, end_date = st.session_state.get('date_range', (data['created_at'].min().normalize(), data['created_at'].max().normalize()))
 subscribed_data = data[(data['subscription_id'].notna()) & 
                        (data['subscription_period_started_at'] >= start_date) & 
                        (data['subscription_period_started_at'] <= end_date)]
@@ -268,100 +301,43 @@ subscribed_data = data[(data['subscription_id'].notna()) &
 # Debug: Print the shape of subscribed_data
 st.write(f"Number of subscribed records: {subscribed_data.shape[0]}")
 
-# Prepare cohort data
-cohort = subscribed_data.groupby('subscription_id').agg({
-    'customer_created_at': 'first',
-    'subscription_period_started_at': 'first',
-    'subscription_status': 'last'
-}).reset_index()
-
-# Calculate months since customer creation
-cohort['months_since_customer_creation'] = ((cohort['subscription_period_started_at'].dt.to_period('M') - 
-                                             cohort['customer_created_at'].dt.to_period('M'))).apply(lambda x: max(0, x.n))
-
-# Calculate total subscriptions
-total_subs = cohort.groupby([
-    cohort['subscription_period_started_at'].dt.to_period('M'), 
-    'months_since_customer_creation'
-])['subscription_id'].nunique().unstack(fill_value=0)
-
-# Calculate churned subscriptions
-churned_subs = cohort[cohort['subscription_status'] == 'inactive'].groupby([
-    cohort['subscription_period_started_at'].dt.to_period('M'), 
-    'months_since_customer_creation'
-])['subscription_id'].nunique().unstack(fill_value=0)
-
-# Ensure both dataframes have the same index and columns
-common_index = total_subs.index.intersection(churned_subs.index)
-common_columns = total_subs.columns.intersection(churned_subs.columns)
-
-total_subs = total_subs.loc[common_index, common_columns]
-churned_subs = churned_subs.loc[common_index, common_columns]
-
-
-# Calculate churn rate
-churn_rate = churned_subs / total_subs
-
-# Replace NaN and inf with 0
-churn_rate = churn_rate.fillna(0).replace([np.inf, -np.inf], 0)
-
-# Sort the columns and index
-churn_rate = churn_rate.sort_index()
-churn_rate = churn_rate.reindex(sorted(churn_rate.columns), axis=1)
-
-# Rename the index for clarity
-churn_rate.index = churn_rate.index.strftime('%Y-%m')
-churn_rate.index.name = 'Subscription Start Month'
-
-# Remove any rows that are all zeros
-churn_rate_cleaned = churn_rate.loc[(churn_rate != 0).any(axis=1)]
-
-# Add "Months Since Customer Creation" as column header
-churn_rate_cleaned.columns.name = "Months Since Customer Creation"
-
-# Function to format cell content
-def format_cell(val, churned, total):
-    return f"{val:.0%}\n({churned}/{total})"
-
-# Create a DataFrame with formatted cell contents
-formatted_matrix = pd.DataFrame(index=churn_rate_cleaned.index, columns=churn_rate_cleaned.columns)
-for idx in churn_rate_cleaned.index:
-    for col in churn_rate_cleaned.columns:
-        formatted_matrix.loc[idx, col] = format_cell(
-            churn_rate_cleaned.loc[idx, col],
-            churned_subs.loc[idx, col],
-            total_subs.loc[idx, col]
-        )
-
-# Function to apply color gradient
-def color_gradient(val):
-    if isinstance(val, str):
-        val = float(val.split('%')[0]) / 100
-    color = "#306BEA"
-    return f'background-color: rgba{tuple(int(color[i:i+2], 16) for i in (1, 3, 5)) + (val,)}'
-
-# Apply formatting and styling
-styled_churn_matrix = formatted_matrix.style.applymap(color_gradient)
-
-# Increase cell size and center text
-styled_churn_matrix = styled_churn_matrix.set_properties(**{
-    'text-align': 'center',
-    'height': '120px',
-    'min-width': '150px',
-    'font-size': '20px',
-    'white-space': 'pre-wrap'
-})
-
-# Add styling for the index and column headers
-styled_churn_matrix = styled_churn_matrix.set_table_styles([
-    {'selector': 'th.col_heading', 'props': [('font-size', '16px'), ('text-align', 'center'), ('padding', '10px')]},
-    {'selector': 'th.row_heading', 'props': [('font-size', '16px'), ('text-align', 'right'), ('padding', '10px')]},
-    {'selector': 'th.col_heading.level0', 'props': [('font-size', '18px'), ('text-align', 'center'), ('padding', '15px')]},
-])
-
-# Display the churn matrix as a table
-st.write("Churn Rate Matrix:")
-st.dataframe(styled_churn_matrix, use_container_width=True, height=500)
+## The matrix runs as a fragment, so switching the cohort view reruns only this section from cached matrices.
+## Cohorts by subscription start month (the default), by customer signup month, or a retention triangle of
+## customers active in each month since signup. Month offsets, counts, labels and colours are whole array operations.
+@st.fragment
+def cohort_matrix_section(data, subscribed_data, state_key):
+    cohort_view = st.selectbox("Cohort view", options=list(cohort_views))
+
+    churn_rate_cleaned, churned_subs, total_subs = get_cohort_matrix(data, subscribed_data, state_key, cohort_view)
+
+    # Create a DataFrame with formatted cell contents and its colour gradient
+    formatted_matrix = cohort_labels(churn_rate_cleaned, churned_subs, total_subs)
+    cell_colors = cohort_colors(churn_rate_cleaned)
+
+    # Apply formatting and styling
+    styled_churn_matrix = formatted_matrix.style.apply(lambda _: cell_colors, axis=None)
+
+    # Increase cell size and center text
+    styled_churn_matrix = styled_churn_matrix.set_properties(**{
+        'text-align': 'center',
+        'height': '120px',
+        'min-width': '150px',
+        'font-size': '20px',
+        'white-space': 'pre-wrap'
+    })
+
+    # Add styling for the index and column headers
+    styled_churn_matrix = styled_churn_matrix.set_table_styles([
+        {'selector': 'th.col_heading', 'props': [('font-size', '16px'), ('text-align', 'center'), ('padding', '10px')]},
+        {'selector': 'th.row_heading', 'props': [('font-size', '16px'), ('text-align', 'right'), ('padding', '10px')]},
+        {'selector': 'th.col_heading.level0', 'props': [('font-size', '18px'), ('text-align', 'center'), ('padding', '15px')]},
+    ])
+
+    # Display the churn matrix as a table
+    st.write("Churn Rate Matrix:")
+    st.dataframe(styled_churn_matrix, use_container_width=True, height=500)
+
+cohort_matrix_section(data, subscribed_data, (cube.state_key, start_date, end_date))
 
 # # Optionally, provide a CSV download link for the full data
 # csv = churn_rate.to_csv().encode('utf-8')
@@ -0,0 +1,26 @@
+import os
+import datetime
+from streamlit.testing.v1 import AppTest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_apply_commits_every_pending_filter_and_date_change(monkeypatch):
+    ## Filter counts and the date range change on the submit rerun; every pending pick must still be applied.
+    monkeypatch.chdir(repo_dir)
+    monkeypatch.syspath_prepend(repo_dir)
+    at = AppTest.from_file(os.path.join(repo_dir, 'pages', '1_orders_and_revenue.py'), default_timeout=120)
+    at.run()
+    assert not at.exception
+
+    start_date, end_date = at.session_state.start_date, at.session_state.end_date
+    new_start = start_date + datetime.timedelta(days=30)
+    at.multiselect(key='filter_subscription_plan').set_value(['Basic'])
+    at.multiselect(key='filter_payment_method').set_value(['bank_transfer'])
+    at.date_input[0].set_value((new_start, end_date))
+    next(button for button in at.button if button.label == 'Apply filters').click()
+    at.run()
+
+    assert not at.exception
+    assert at.session_state.filter_values['Subscription Plan'] == ['Basic']
+    assert at.session_state.filter_values['Payment Method'] == ['bank_transfer']
+    assert (at.session_state.start_date, at.session_state.end_date) == (new_start, end_date)